@@ -0,0 +1,294 @@
+import os, sys, json, time, argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+
+import tiling
+from filters import FILTERS
+from history import OPERATIONS, SETTING_OPERATIONS, Operation
+from loading import decode
+from pipeline import Adjustments, BACKENDS, apply_all_adjustments
+from quality_search import MAX_QUALITY, search_quality
+from saving import encode, save_atomic, write_atomic
+try:
+    import numpy_backend  # registers the "numpy" render backend
+except ImportError:
+    numpy_backend = None
+
+
+# Applies a recipe to every image in a directory without the GUI:
+#
+#   python batch.py recipe.json photos/ out/ [--workers N] [--resume]
+#   python main.py batch recipe.json photos/ out/ ...
+#
+# A recipe is a JSON object, every key optional:
+#
+#   {
+#     "operations": [["rotate", 90], ["crop", [0, 0, 800, 600]], ["resize", [400, 300]], ["mirror"]],
+#     "adjustments": {"red": 100, "brightness": 10, "contrast": 5, "filters": ["sharpen"]},
+#     "format": "JPEG",
+#     "params": {"quality": 85, "optimize": true}
+#   }
+#
+# operations run first and in order, as in the edit history, then the slider
+# settings are rendered on top like a save from the window. format defaults to
+# the input's own; inputs it would convert to the same output name, like a.png
+# and a.jpg to JPEG, fail instead of overwriting each other. "target_size" in
+# params (bytes) picks the highest JPEG or WebP quality within it, see
+# quality_search.py.
+
+
+# extension for results converted to another format, Pillow lists .jfif first for JPEG
+EXTENSIONS = {"JPEG": ".jpg", "TIFF": ".tif"}
+
+
+class RecipeError(ValueError):
+    pass
+
+
+def tuples(value):
+    # JSON has only lists, the operations take tuples for boxes and sizes
+    return tuple(tuples(item) for item in value) if isinstance(value, list) else value
+
+
+def load_recipe(path):
+    try:
+        with open(path, encoding="utf-8") as file:
+            recipe = json.load(file)
+    except (OSError, ValueError) as error:
+        raise RecipeError(f"cannot read recipe {path}: {error}")
+    if not isinstance(recipe, dict):
+        raise RecipeError("the recipe must be a JSON object")
+
+    steps = recipe.get("operations", [])
+    if not isinstance(steps, list):
+        raise RecipeError("operations must be a list")
+    operations = []
+    for step in steps:
+        name, *params = step if isinstance(step, list) and step else [step]
+        if not isinstance(name, str) or name not in OPERATIONS or name in SETTING_OPERATIONS:
+            raise RecipeError(f"unknown operation: {json.dumps(step)}")
+        operations.append(Operation(name, tuples(params)))
+
+    settings = recipe.get("adjustments", {})
+    if not isinstance(settings, dict):
+        raise RecipeError("adjustments must be an object")
+    settings = dict(settings)
+    if not isinstance(settings.get("filters", []), list):
+        raise RecipeError("filters must be a list of names")
+    settings["filters"] = tuple(settings.get("filters", ()))
+    unknown = [name for name in settings["filters"] if not isinstance(name, str) or name not in FILTERS]
+    if unknown:
+        raise RecipeError(f"unknown filters: {', '.join(map(json.dumps, unknown))}")
+    # the Filter menu order, whatever order the recipe lists them in
+    settings["filters"] = tuple(name for name in FILTERS if name in settings["filters"])
+    try:
+        adjustments = Adjustments(**settings)
+    except TypeError as error:
+        raise RecipeError(f"bad adjustments: {error}")
+
+    image_type = recipe.get("format")
+    if image_type is not None:
+        if not isinstance(image_type, str):
+            raise RecipeError(f"format must be a name like \"JPEG\", not {json.dumps(image_type)}")
+        image_type = image_type.upper()
+        if image_type not in Image.registered_extensions().values():
+            raise RecipeError(f"unknown format: {image_type}")
+    params = recipe.get("params", {})
+    if not isinstance(params, dict):
+        raise RecipeError("params must be an object")
+    params = dict(params)
+    if "target_size" in params and image_type not in MAX_QUALITY:
+        raise RecipeError(f"target_size needs format {' or '.join(MAX_QUALITY)}")
+    check_recipe(operations, adjustments, image_type, params)
+    return operations, adjustments, image_type, params
+
+
+def check_recipe(operations, adjustments, image_type, params):
+    # runs the recipe on a single pixel, so a wrong argument stops the run
+    # before it starts instead of failing every file the same way
+    image = Image.new("RGB", (1, 1))
+    for operation in operations:
+        try:
+            image = operation.apply(image)
+        except (TypeError, ValueError, IndexError, AttributeError, OSError) as error:
+            raise RecipeError(f"bad operation {operation.name}{list(operation.params)}: {error}")
+    try:
+        image = apply_all_adjustments(image, adjustments)
+    except (TypeError, ValueError) as error:
+        raise RecipeError(f"bad adjustments: {error}")
+    if image_type is not None:
+        codec_params = {key: value for key, value in params.items() if key != "target_size"}
+        try:
+            encode(image, image_type, codec_params)
+        except (TypeError, ValueError, KeyError, OSError) as error:
+            raise RecipeError(f"bad params for {image_type}: {error}")
+
+
+def output_path(path, output_dir, image_type):
+    name = os.path.basename(path)
+    extensions = Image.registered_extensions()
+    if image_type is not None and extensions.get(os.path.splitext(name)[1].lower()) != image_type:
+        extension = EXTENSIONS.get(image_type) or next(ext for ext, known in extensions.items() if known == image_type)
+        name = os.path.splitext(name)[0] + extension
+    return os.path.join(output_dir, name)
+
+
+def input_paths(input_dir):
+    # files Pillow knows by extension, in name order
+    extensions = Image.registered_extensions()
+    return sorted(
+        entry.path
+        for entry in os.scandir(input_dir)
+        if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions
+    )
+
+
+def init_worker():
+    # the pool already keeps every core busy with one image each, strips
+    # split across threads would only compete with it
+    tiling.WORKERS = 1
+
+
+def process(path, target, recipe, backend):
+    # runs in a worker process; returns (pixels, timings) or raises
+    operations, adjustments, image_type, params = recipe
+    timings = {}
+
+    start = time.perf_counter()
+    image = decode(path)
+    pixels = image.width * image.height
+    timings["decode"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for operation in operations:
+        image = operation.apply(image)
+    image = apply_all_adjustments(image, adjustments, backend)
+    timings["edit"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if "target_size" in params:
+        # files are already spread over the pool, the search stays in this process
+        found = search_quality(image, image_type, params["target_size"], params, workers=0)
+        if found is None:
+            raise ValueError(f"does not fit in {params['target_size']} bytes at any quality")
+        write_atomic(target, lambda file: file.write(found[1]))
+    else:
+        save_atomic(image, target, **params)
+    timings["save"] = time.perf_counter() - start
+    return pixels, timings
+
+
+def format_timings(timings):
+    return ", ".join(f"{stage} {seconds * 1000:.0f}" for stage, seconds in timings.items())
+
+
+def run(recipe_path, input_dir, output_dir, workers=None, resume=False, backend="pillow", out=sys.stdout):
+    recipe = load_recipe(recipe_path)
+    image_type = recipe[2]
+    os.makedirs(output_dir, exist_ok=True)
+
+    # converting can give two inputs the same output, a.png and a.jpg both
+    # make a.jpg; neither is written rather than one over the other
+    sources = {}
+    for path in input_paths(input_dir):
+        target = output_path(path, output_dir, image_type)
+        sources.setdefault(os.path.normcase(target), []).append((path, target))
+
+    jobs, skipped, failed = [], 0, 0
+    for paths in sources.values():
+        if len(paths) > 1:
+            names = ", ".join(os.path.basename(path) for path, _ in paths)
+            for path, target in paths:
+                failed += 1
+                print(f"failed  {os.path.basename(path)}: {names} all go to {os.path.basename(target)}", file=out)
+            continue
+        path, target = paths[0]
+        # outputs are written atomically, one that exists is complete
+        if resume and os.path.exists(target):
+            skipped += 1
+            continue
+        jobs.append((path, target))
+
+    processes = workers or tiling.WORKERS
+    done = 0
+    total_pixels = 0
+
+    def collect(future, path):
+        # reports the file's result; True when it was lost with a broken pool instead
+        nonlocal done, failed, total_pixels
+        name = os.path.basename(path)
+        try:
+            pixels, timings = future.result()
+        except BrokenProcessPool:
+            return True
+        except Exception as error:
+            # one bad file, even a MemoryError, must not cost the others their results
+            failed += 1
+            print(f"failed  {name}: {str(error) or type(error).__name__}", file=out, flush=True)
+            return False
+        done += 1
+        total_pixels += pixels
+        total = sum(timings.values())
+        print(f"done    {name} {total * 1000:.0f} ms ({format_timings(timings)})", file=out, flush=True)
+        return False
+
+    start = time.perf_counter()
+    while jobs:
+        crashed, broken = [], False
+        with ProcessPoolExecutor(max_workers=processes, initializer=init_worker) as pool:
+            # a file per worker and one waiting, the rest stay here: a worker
+            # that dies breaks the pool and every file submitted to it
+            running = {}
+            while (jobs and not broken) or running:
+                while jobs and not broken and len(running) <= processes:
+                    path, target = jobs.pop(0)
+                    try:
+                        running[pool.submit(process, path, target, recipe, backend)] = path, target
+                    except BrokenProcessPool:
+                        jobs.insert(0, (path, target))
+                        broken = True
+                # results are reported as they finish, not in submission order
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    if collect(future, job[0]):
+                        crashed.append(job)
+                        broken = True
+
+        # the worker died, e.g. killed when out of memory, and took the files
+        # in flight with it; each runs alone to tell which one did it
+        for path, target in crashed:
+            with ProcessPoolExecutor(max_workers=1, initializer=init_worker) as pool:
+                if collect(pool.submit(process, path, target, recipe, backend), path):
+                    failed += 1
+                    print(f"failed  {os.path.basename(path)}: the worker process died", file=out, flush=True)
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{done} done, {failed} failed, {skipped} skipped in {elapsed:.1f} s: "
+        f"{done / max(elapsed, 1e-9):.2f} images/s, {total_pixels / 1e6 / max(elapsed, 1e-9):.1f} MP/s",
+        file=out,
+    )
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="filtroo batch", description="Apply an edit recipe to a directory of images")
+    parser.add_argument("recipe", help="JSON recipe: operations, adjustments, format and params")
+    parser.add_argument("input", help="directory with the images to edit")
+    parser.add_argument("output", help="directory for the results, created if missing")
+    parser.add_argument("--workers", type=int, help=f"processes (default {tiling.WORKERS})")
+    parser.add_argument("--resume", action="store_true", help="skip images whose result already exists")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="pillow")
+    args = parser.parse_args(argv)
+    try:
+        failed = run(args.recipe, args.input, args.output, args.workers, args.resume, args.backend)
+    except (RecipeError, OSError) as error:
+        print(f"error: {error}", file=sys.stderr)
+        return 2
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
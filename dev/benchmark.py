@@ -0,0 +1,419 @@
+import os, sys, io, time, json, platform, argparse, tempfile
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtGui, QtWidgets
+from PIL import Image, ImageChops, ImageEnhance
+
+import PIL
+import tiling
+import pipeline
+from PyQt5.QtCore import QT_VERSION_STR, PYQT_VERSION_STR
+from PyQt5.QtCore import Qt, QSize
+from bridge import pil_to_pixmap
+from filters import apply_filters
+from pipeline import Adjustments, BACKENDS, apply_all_adjustments
+from viewer import TiledImageView
+from loading import open_preview, decode
+from export import estimate, sample_image
+from saving import encode
+from quality_search import WORKERS, search_quality
+try:
+    import numpy_backend
+except ImportError:
+    numpy_backend = None
+
+
+def png_to_pixmap(pil_image):
+    # the old pil_image_to_pixmap: PNG encode + decode
+    if pil_image.mode != "RGBA":
+        pil_image = pil_image.convert("RGBA")
+    buffer = io.BytesIO()
+    pil_image.save(buffer, format="PNG")
+    pixmap = QtGui.QPixmap()
+    pixmap.loadFromData(buffer.getvalue())
+    return pixmap
+
+
+def legacy_adjustments(image, adjustments):
+    # the old update_colors -> update_enhancements chain, one pass per step
+    red_factor, green_factor, blue_factor = adjustments.gains
+    r, g, b = image.split()
+    r = r.point(lambda i: max(0, min(255, int(i * red_factor))))
+    g = g.point(lambda i: max(0, min(255, int(i * green_factor))))
+    b = b.point(lambda i: max(0, min(255, int(i * blue_factor))))
+    image = Image.merge("RGB", (r, g, b))
+    image = ImageEnhance.Brightness(image).enhance(adjustments.brightness_factor)
+    image = ImageEnhance.Contrast(image).enhance(adjustments.contrast_factor)
+    image = ImageEnhance.Sharpness(image).enhance(adjustments.sharpness_factor)
+    image = ImageEnhance.Color(image).enhance(adjustments.saturation_factor)
+    return apply_filters(image, adjustments.filters)
+
+
+SETTINGS = {
+    "neutral": Adjustments(),
+    "colors": Adjustments(red=130, green=90, blue=110),
+    "tone": Adjustments(red=130, green=90, blue=110, brightness=8, contrast=-12),
+    "matrix": Adjustments(red=110, green=90, blue=105, brightness=-4, contrast=-6, saturation=15),
+    "all": Adjustments(red=130, green=90, blue=110, brightness=8, contrast=-12, sharpness=20, saturation=15),
+}
+
+
+def max_difference(first, second):
+    return max(high for _, high in ImageChops.difference(first, second).getextrema())
+
+
+def make_image(megapixels, mode):
+    width = int((megapixels * 1_000_000 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    image = Image.linear_gradient("L").resize((width, height))
+    image = Image.merge("RGB", (image, image.rotate(90).resize((width, height)), Image.effect_noise((width, height), 40)))
+    return image.convert(mode)
+
+
+def best_time(func, image, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(image)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_conversion(sizes, modes, repeat):
+    print(f"{'size':>6} {'mode':>5} {'png [ms]':>10} {'bridge [ms]':>12} {'speedup':>8}")
+    for megapixels in sizes:
+        for mode in modes:
+            image = make_image(megapixels, mode)
+            png = best_time(png_to_pixmap, image, repeat)
+            bridge = best_time(pil_to_pixmap, image, repeat)
+            print(f"{megapixels:>4}MP {mode:>5} {png * 1000:>10.1f} {bridge * 1000:>12.1f} {png / bridge:>7.1f}x")
+
+
+def tone_passes(image, adjustments):
+    # how the pillow backend applies gains, brightness, contrast and saturation
+    saturation = pipeline.folded_saturation(adjustments)
+    if saturation == 1:
+        return "table"
+    gains, brightness, contrast = adjustments.gains, adjustments.brightness_factor, adjustments.contrast_factor
+    _, mean = pipeline.tone_lut(image, gains, brightness, contrast)
+    if pipeline.single_matrix(image, gains, brightness, contrast, mean, saturation):
+        return "matrix"
+    return "table+matrix"
+
+
+def bench_pipeline(sizes, repeat):
+    print(f"{'size':>6} {'settings':>9} {'legacy [ms]':>12} {'fused [ms]':>11} {'MP/s':>7} {'speedup':>8} {'max diff':>9}"
+          f" {'tone passes':>13}")
+    for megapixels in sizes:
+        image = make_image(megapixels, "RGB")
+        for name, adjustments in SETTINGS.items():
+            legacy = best_time(lambda im: legacy_adjustments(im, adjustments), image, repeat)
+            fused = best_time(lambda im: apply_all_adjustments(im, adjustments), image, repeat)
+            diff = max_difference(legacy_adjustments(image, adjustments), apply_all_adjustments(image, adjustments))
+            print(f"{megapixels:>4}MP {name:>9} {legacy * 1000:>12.1f} {fused * 1000:>11.1f} "
+                  f"{megapixels / fused:>7.0f} {legacy / fused:>7.1f}x {diff:>9} {tone_passes(image, adjustments):>13}")
+
+
+def bench_backends(sizes, repeat):
+    names = list(BACKENDS)
+    print(f"{'size':>6} {'settings':>9} " + " ".join(f"{name + ' [ms]':>12}" for name in names) + f" {'fastest':>8}")
+    for megapixels in sizes:
+        image = make_image(megapixels, "RGB")
+        for setting, adjustments in SETTINGS.items():
+            timings = {
+                name: best_time(lambda im: apply_all_adjustments(im, adjustments, name), image, repeat)
+                for name in names
+            }
+            print(f"{megapixels:>4}MP {setting:>9} " + " ".join(f"{timings[name] * 1000:>12.1f}" for name in names)
+                  + f" {min(timings, key=timings.get):>8}")
+
+
+def bench_tiling(sizes, repeat):
+    adjustments = Adjustments(sharpness=20, filters=("detail", "sharpen", "smooth"))
+    workers = tiling.WORKERS
+    print(f"{'size':>6} {'1 thread [ms]':>14} {f'{workers} threads [ms]':>16} {'speedup':>8}")
+    for megapixels in sizes:
+        image = make_image(megapixels, "RGB")
+        try:
+            tiling.WORKERS = 1
+            single = best_time(lambda im: apply_all_adjustments(im, adjustments), image, repeat)
+        finally:
+            tiling.WORKERS = workers
+        parallel = best_time(lambda im: apply_all_adjustments(im, adjustments), image, repeat)
+        print(f"{megapixels:>4}MP {single * 1000:>14.1f} {parallel * 1000:>16.1f} {single / parallel:>7.1f}x")
+
+
+VIEWPORT = QSize(800, 600)
+ZOOM_DRAG = list(range(100, 10, -3)) + list(range(10, 100, 3))  # zoomSlider values, out and back in
+FRAME_BUDGET = 1 / 30
+
+
+def drag_frames(frame, size):
+    # a zoom slider drag: one frame per slider step, fitted size times value / 100
+    fit = min(VIEWPORT.width() / size.width(), VIEWPORT.height() / size.height())
+    timings = []
+    for value in ZOOM_DRAG:
+        start = time.perf_counter()
+        frame(size * (fit * value / 100))
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)
+
+
+def bench_zoom(sizes, repeat):
+    print(f"{'size':>6} {'path':>14} {'mean [ms]':>10} {'p95 [ms]':>9} {'worst [ms]':>11} {'fps':>6} {'>= 30 fps':>10}")
+    for megapixels in sizes:
+        pixmap = pil_to_pixmap(make_image(megapixels, "RGB"))
+        area = QtWidgets.QScrollArea()
+        area.setWidgetResizable(True)
+        area.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        area.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        area.resize(VIEWPORT)
+        view = TiledImageView()
+        area.setWidget(view)
+        view.set_image(pixmap, pixmap.size())
+
+        def tiled(smooth):
+            def frame(size):
+                view.set_smooth(smooth)
+                view.set_display_size(size)
+                area.viewport().grab()
+            return frame
+
+        def whole(size):
+            # before the pyramid and the tiles: the full pixmap scaled smoothly every frame
+            pixmap.scaled(size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+        paths = {"full pixmap": whole, "tiles smooth": tiled(True), "tiles fast": tiled(False)}
+        for name, frame in paths.items():
+            runs = []
+            for _ in range(repeat):
+                view.tiles.clear()  # a fresh drag, not one over tiles cached by the last run
+                runs.append(drag_frames(frame, pixmap.size()))
+            timings = min(runs, key=sum)
+            mean = sum(timings) / len(timings)
+            p95 = timings[int(len(timings) * 0.95)]
+            print(f"{megapixels:>4}MP {name:>14} {mean * 1000:>10.1f} {p95 * 1000:>9.1f} {timings[-1] * 1000:>11.1f} "
+                  f"{1 / mean:>6.0f} {'yes' if p95 <= FRAME_BUDGET else 'no':>10}")
+        area.close()
+
+
+def legacy_open(path):
+    # the old open_file: open, then two full copies before anything is shown
+    image = Image.open(path)
+    return image.copy(), image.copy()
+
+
+def bench_open(sizes, repeat):
+    screen = (1920, 1080)
+    print(f"{'size':>6} {'legacy open [ms]':>17} {'preview [ms]':>13} {'preview size':>13} {'full decode [ms]':>17}")
+    for megapixels in sizes:
+        path = os.path.join(tempfile.gettempdir(), f"filtroo_bench_{megapixels}mp.jpg")
+        make_image(megapixels, "RGB").save(path, quality=90)
+        try:
+            legacy = best_time(legacy_open, path, repeat)
+            preview = best_time(lambda p: open_preview(p, screen), path, repeat)
+            full = best_time(decode, path, repeat)
+            preview_image, _ = open_preview(path, screen)
+            size = "x".join(map(str, preview_image.size)) if preview_image else "-"
+            print(f"{megapixels:>4}MP {legacy * 1000:>17.1f} {preview * 1000:>13.1f} {size:>13} {full * 1000:>17.1f}")
+        finally:
+            os.remove(path)
+
+
+EXPORT_SETTINGS = (
+    ("JPEG", {"quality": 85, "subsampling": 2}),
+    ("JPEG", {"quality": 60, "progressive": True, "optimize": True, "subsampling": 2}),
+    ("JPEG", {"quality": 95, "subsampling": 0}),
+    ("PNG", {"compress_level": 6}),
+    ("WEBP", {"quality": 80, "method": 4}),
+)
+
+
+def bench_export(sizes, repeat):
+    print(f"{'size':>6} {'format':>6} {'params':>62} {'estimate [KB]':>14} {'actual [KB]':>12} {'error':>7} "
+          f"{'estimate [ms]':>14} {'actual [ms]':>12}")
+    for megapixels in sizes:
+        image = make_image(megapixels, "RGB")
+        sample, scale = sample_image(image)
+        for image_format, params in EXPORT_SETTINGS:
+            nbytes, seconds, _ = estimate(sample, scale, image_format, params)
+            actual = len(encode(image, image_format, params))
+            actual_seconds = best_time(lambda im: encode(im, image_format, params), image, repeat)
+            print(f"{megapixels:>4}MP {image_format:>6} {str(params):>62} {nbytes / 1024:>14.0f} {actual / 1024:>12.0f} "
+                  f"{(nbytes - actual) / actual:>+7.0%} {seconds * 1000:>14.0f} {actual_seconds * 1000:>12.0f}")
+
+
+TARGET_SIZES = (("JPEG", 300 * 1024), ("WEBP", 300 * 1024))
+
+
+def bench_target(sizes, repeat):
+    # one quality at a time in this process against a pool trying several per round
+    pools = sorted({0, 1, WORKERS, max(WORKERS, 4)})
+    print(f"{'size':>6} {'format':>6} {'target [KB]':>12} {'quality':>8} {'size [KB]':>10} "
+          + " ".join(f"{f'{workers} procs [ms]' if workers else 'serial [ms]':>15}" for workers in pools))
+    for megapixels in sizes:
+        image = make_image(megapixels, "RGB")
+        for image_format, target in TARGET_SIZES:
+            quality, data = search_quality(image, image_format, target, workers=0) or (0, b"")
+            timings = [
+                best_time(lambda im: search_quality(im, image_format, target, workers=workers), image, repeat)
+                for workers in pools
+            ]
+            print(f"{megapixels:>4}MP {image_format:>6} {target / 1024:>12.0f} {quality:>8} {len(data) / 1024:>10.0f} "
+                  + " ".join(f"{seconds * 1000:>15.0f}" for seconds in timings))
+
+
+# ================ Regression suite =================
+SUITE_SIZES = (1, 12, 24, 50)
+SUITE_MODES = ("RGB", "RGBA", "L", "P")
+SUITE_SETTINGS = dict(SETTINGS, filters=Adjustments(filters=("blur", "sharpen", "smooth")))
+
+
+def apply_settings(window, adjustments):
+    ui = window.ui
+    for slider, value in (
+        (ui.r_slider, adjustments.red),
+        (ui.g_slider, adjustments.green),
+        (ui.b_slider, adjustments.blue),
+        (ui.brightness_slider, adjustments.brightness),
+        (ui.contrast_slider, adjustments.contrast),
+        (ui.sharpness_slider, adjustments.sharpness),
+        (ui.saturation_slider, adjustments.saturation),
+    ):
+        slider.setValue(value)
+    for name, action in window.filter_actions().items():
+        action.setChecked(name in adjustments.filters)
+
+
+def clear_memos():
+    # every repetition should pay for histograms and degenerate images again
+    pipeline.histograms.clear()
+    pipeline.gray_means.clear()
+    pipeline.degenerates.clear()
+
+
+def cold_time(func, image, repeat):
+    def run(image):
+        clear_memos()
+        func(image)
+    return best_time(run, image, repeat)
+
+
+def suite_stages(window):
+    return {
+        "to_rgb": lambda image: image.convert("RGB"),
+        "update_colors": lambda image: window.update_colors(image.convert("RGB")),
+        "update_enhancements": lambda image: window.update_enhancements(image.convert("RGB")),
+        "update_filters": lambda image: window.update_filters(image.convert("RGB")),
+        "pil_image_to_pixmap": window.pil_image_to_pixmap,
+    }
+
+
+def compare_results(results, baseline_path, threshold):
+    with open(baseline_path) as file:
+        baseline = {
+            (r["stage"], r["megapixels"], r["mode"], r["settings"]): r["seconds"]
+            for r in json.load(file)["results"]
+        }
+    regressions = 0
+    for result in results:
+        key = (result["stage"], result["megapixels"], result["mode"], result["settings"])
+        if key in baseline and result["seconds"] > baseline[key] * threshold:
+            regressions += 1
+            print(f"REGRESSION {'/'.join(map(str, key))}: "
+                  f"{baseline[key] * 1000:.1f} ms -> {result['seconds'] * 1000:.1f} ms")
+    print(f"{regressions} regressions against {baseline_path}")
+    return regressions
+
+
+# Drives the MainWindow stage methods headlessly over sizes x modes x settings.
+def bench_suite(sizes, modes, repeat, output, compare=None, threshold=1.2):
+    from main import MainWindow
+
+    window = MainWindow()
+    stages = suite_stages(window)
+    results = []
+    print(f"{'size':>6} {'mode':>5} {'settings':>9} {'stage':>20} {'time [ms]':>10}")
+    try:
+        for megapixels in sizes:
+            for mode in modes:
+                image = make_image(megapixels, mode)
+                for setting, adjustments in SUITE_SETTINGS.items():
+                    apply_settings(window, adjustments)
+                    for stage, func in stages.items():
+                        seconds = cold_time(func, image, repeat)
+                        results.append({
+                            "stage": stage, "megapixels": megapixels, "mode": mode,
+                            "settings": setting, "seconds": seconds,
+                        })
+                        print(f"{megapixels:>4}MP {mode:>5} {setting:>9} {stage:>20} {seconds * 1000:>10.1f}")
+                del image
+    finally:
+        window.close()
+
+    report = {
+        "meta": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "qt": QT_VERSION_STR,
+            "pyqt": PYQT_VERSION_STR,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": window.render_pipeline.backend,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+    with open(output, "w") as file:
+        json.dump(report, file, indent=1)
+    print(f"Results written to {output}")
+
+    if compare:
+        return compare_results(results, compare, threshold)
+    return 0
+
+
+BENCHMARKS = ("conversion", "pipeline", "backends", "tiling", "zoom", "open", "export", "target", "suite")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Filtroo benchmarks")
+    # checked below, argparse also holds an empty list against choices
+    parser.add_argument("benchmarks", nargs="*", help=f"any of: {', '.join(BENCHMARKS)} (default all but suite)")
+    parser.add_argument("--sizes", type=float, nargs="+", help="image sizes in MP")
+    parser.add_argument("--modes", nargs="+")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", default="benchmark.json", help="suite: where to write the results")
+    parser.add_argument("--compare", help="suite: earlier results to check for regressions")
+    parser.add_argument("--threshold", type=float, default=1.2, help="suite: slowdown that counts as a regression")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    # the suite runs only when asked for by name, it takes a long while
+    args.benchmarks = args.benchmarks or BENCHMARKS[:-1]
+    sizes = args.sizes or [1, 12, 24]
+
+    app = QtWidgets.QApplication(sys.argv)
+    if "conversion" in args.benchmarks:
+        bench_conversion(sizes, args.modes or ["RGB", "RGBA"], args.repeat)
+    if "pipeline" in args.benchmarks:
+        bench_pipeline(sizes, args.repeat)
+    if "backends" in args.benchmarks:
+        bench_backends(sizes, args.repeat)
+    if "tiling" in args.benchmarks:
+        bench_tiling(sizes, args.repeat)
+    if "zoom" in args.benchmarks:
+        bench_zoom(sizes, args.repeat)
+    if "open" in args.benchmarks:
+        bench_open(sizes, args.repeat)
+    if "export" in args.benchmarks:
+        bench_export(sizes, args.repeat)
+    if "target" in args.benchmarks:
+        bench_target(sizes, args.repeat)
+    if "suite" in args.benchmarks:
+        regressions = bench_suite(
+            args.sizes or SUITE_SIZES, args.modes or SUITE_MODES, args.repeat, args.json, args.compare, args.threshold
+        )
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,34 @@
+from PyQt5 import QtGui
+
+
+# PIL mode -> (QImage format, bytes per pixel)
+QT_FORMATS = {
+    "RGB": (QtGui.QImage.Format_RGB888, 3),
+    "RGBA": (QtGui.QImage.Format_RGBA8888, 4),
+    "L": (QtGui.QImage.Format_Grayscale8, 1),
+}
+
+
+def displayable(pil_image):
+    if pil_image.mode in QT_FORMATS:
+        return pil_image
+    if pil_image.mode in ("LA", "La", "PA", "RGBa") or "transparency" in pil_image.info:
+        return pil_image.convert("RGBA")
+    return pil_image.convert("RGB")
+
+
+def pil_to_qimage(pil_image):
+    pil_image = displayable(pil_image)
+    qt_format, depth = QT_FORMATS[pil_image.mode]
+    width, height = pil_image.size
+
+    # tobytes() is the only copy: QImage wraps the raw buffer as-is, no encoding
+    data = pil_image.tobytes("raw", pil_image.mode)
+    qimage = QtGui.QImage(data, width, height, width * depth, qt_format)
+    # QImage does not own the memory it wraps, so the buffer has to live as long as the image
+    qimage._buffer = data
+    return qimage
+
+
+def pil_to_pixmap(pil_image):
+    return QtGui.QPixmap.fromImage(pil_to_qimage(pil_image))
@@ -0,0 +1,212 @@
+import os, math, time
+from PyQt5 import QtCore, QtWidgets
+from PIL import Image
+
+from saving import encode
+from quality_search import MAX_QUALITY, search_quality
+
+
+EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+SUBSAMPLING = {"4:4:4": 0, "4:2:2": 1, "4:2:0": 2}
+
+# The estimate encodes a mosaic of full resolution tiles spread over the image.
+# A downscaled copy would pack more detail into each pixel and overestimate;
+# tiles keep the image's own level of detail and noise.
+SAMPLE_PIXELS = 1_000_000
+SAMPLE_TILE = 128
+
+
+def sample_image(image, pixels=SAMPLE_PIXELS, tile=SAMPLE_TILE):
+    # returns the sample and how many times more pixels the image has
+    width, height = image.size
+    if width * height <= pixels or width < tile or height < tile:
+        return image, 1.0
+    columns = rows = max(1, int(math.sqrt(pixels) // tile))
+    columns, rows = min(columns, width // tile), min(rows, height // tile)
+    sample = Image.new(image.mode, (columns * tile, rows * tile))
+    if image.mode == "P":
+        sample.putpalette(image.getpalette())
+    for row in range(rows):
+        for column in range(columns):
+            # tile centres evenly spread, not touching the edges
+            x = (2 * column + 1) * width // (2 * columns) - tile // 2
+            y = (2 * row + 1) * height // (2 * rows) - tile // 2
+            sample.paste(image.crop((x, y, x + tile, y + tile)), (column * tile, row * tile))
+    return sample, width * height / (sample.width * sample.height)
+
+
+def estimate(sample, scale, image_format, params):
+    # predicted (bytes, seconds, quality) for the whole image, quality is None
+    # unless params ask for a target size
+    if "target_size" in params:
+        return estimate_target(sample, scale, image_format, params)
+    timings = []
+    while not timings or (len(timings) < 3 and sum(timings) < 0.1):
+        # quick encodes are repeated, the first one also pays for warming up the codec
+        start = time.perf_counter()
+        data = encode(sample, image_format, params)
+        timings.append(time.perf_counter() - start)
+    return len(data) * scale, min(timings) * scale, None
+
+
+def estimate_target(sample, scale, image_format, params):
+    # the sample gets its share of the target, the quality found for it is
+    # close to the one the whole image will get
+    start = time.perf_counter()
+    found = search_quality(sample, image_format, params["target_size"] / scale, params, workers=0)
+    seconds = (time.perf_counter() - start) * scale
+    if found is None:
+        raise ValueError("does not fit at any quality")
+    quality, data = found
+    return len(data) * scale, seconds, quality
+
+
+def has_extension(path, image_format):
+    # any of the format's extensions, .jpeg and .jfif count for JPEG too
+    extension = os.path.splitext(path)[1].lower()
+    return Image.registered_extensions().get(extension) == image_format
+
+
+def format_size(nbytes):
+    if nbytes < 1024 * 1024:
+        return f"{nbytes / 1024:.0f} KB"
+    return f"{nbytes / 2**20:.1f} MB"
+
+
+class ExportDialog(QtWidgets.QDialog):
+    # (format, params) whenever an option changes
+    settings_changed = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Export")
+        self.setStyleSheet("color: #dddddd;")
+
+        self.format_box = QtWidgets.QComboBox()
+        self.format_box.addItems(list(EXTENSIONS))
+        self.pages = QtWidgets.QStackedWidget()
+
+        # JPEG
+        self.jpeg_quality = self.spin_box(1, 95, 85)
+        self.jpeg_progressive = QtWidgets.QCheckBox("Progressive")
+        self.jpeg_optimize = QtWidgets.QCheckBox("Optimize Huffman tables")
+        self.jpeg_subsampling = QtWidgets.QComboBox()
+        self.jpeg_subsampling.addItems(list(SUBSAMPLING))
+        self.jpeg_subsampling.setCurrentText("4:2:0")
+        self.add_page(
+            ("Quality", self.jpeg_quality),
+            ("Chroma subsampling", self.jpeg_subsampling),
+            ("", self.jpeg_progressive),
+            ("", self.jpeg_optimize),
+        )
+
+        # PNG
+        self.png_level = self.spin_box(0, 9, 6)
+        self.png_optimize = QtWidgets.QCheckBox("Optimize (slow)")
+        self.add_page(("Compression level", self.png_level), ("", self.png_optimize))
+
+        # WebP
+        self.webp_quality = self.spin_box(1, 100, 80)
+        self.webp_lossless = QtWidgets.QCheckBox("Lossless")
+        self.webp_method = self.spin_box(0, 6, 4)
+        self.add_page(
+            ("Quality", self.webp_quality),
+            ("Method (slower, smaller)", self.webp_method),
+            ("", self.webp_lossless),
+        )
+
+        # JPEG and WebP can instead look for the highest quality within a size
+        self.target_enabled = QtWidgets.QCheckBox("Highest quality within")
+        self.target_size = self.spin_box(10, 100_000, 300)
+        self.target_size.setSuffix(" KB")
+        self.target_size.setEnabled(False)
+        target_row = QtWidgets.QHBoxLayout()
+        target_row.addWidget(self.target_enabled)
+        target_row.addWidget(self.target_size)
+
+        self.estimate_label = QtWidgets.QLabel("Estimating...")
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QtWidgets.QFormLayout(self)
+        layout.addRow("Format", self.format_box)
+        layout.addRow(self.pages)
+        layout.addRow("Target size", target_row)
+        layout.addRow("Estimated size", self.estimate_label)
+        layout.addRow(buttons)
+
+        self.format_box.currentIndexChanged.connect(self.pages.setCurrentIndex)
+        self.format_box.currentIndexChanged.connect(self.update_target)
+        self.target_enabled.toggled.connect(self.update_target)
+        self.webp_lossless.toggled.connect(self.update_target)
+        for widget in self.findChildren(QtWidgets.QSpinBox):
+            widget.valueChanged.connect(self.on_changed)
+        for widget in self.findChildren(QtWidgets.QCheckBox):
+            widget.toggled.connect(self.on_changed)
+        for widget in self.findChildren(QtWidgets.QComboBox):
+            widget.currentIndexChanged.connect(self.on_changed)
+
+    def spin_box(self, minimum, maximum, value):
+        box = QtWidgets.QSpinBox()
+        box.setRange(minimum, maximum)
+        box.setValue(value)
+        return box
+
+    def add_page(self, *rows):
+        page = QtWidgets.QWidget()
+        form = QtWidgets.QFormLayout(page)
+        form.setContentsMargins(0, 0, 0, 0)
+        for label, widget in rows:
+            form.addRow(label, widget)
+        self.pages.addWidget(page)
+
+    def image_format(self):
+        return self.format_box.currentText()
+
+    def target(self):
+        # target size in bytes, or None
+        if self.image_format() in MAX_QUALITY and self.target_enabled.isChecked():
+            if not (self.image_format() == "WEBP" and self.webp_lossless.isChecked()):
+                return self.target_size.value() * 1024
+        return None
+
+    def update_target(self):
+        self.target_enabled.setEnabled(self.image_format() in MAX_QUALITY)
+        self.target_size.setEnabled(self.target() is not None)
+        self.jpeg_quality.setEnabled(self.target() is None)
+        self.webp_quality.setEnabled(self.target() is None)
+
+    def params(self):
+        params = self.codec_params()
+        if self.target() is not None:
+            params["target_size"] = self.target()
+            del params["quality"]
+        return params
+
+    def codec_params(self):
+        image_format = self.image_format()
+        if image_format == "JPEG":
+            return {
+                "quality": self.jpeg_quality.value(),
+                "progressive": self.jpeg_progressive.isChecked(),
+                "optimize": self.jpeg_optimize.isChecked(),
+                "subsampling": SUBSAMPLING[self.jpeg_subsampling.currentText()],
+            }
+        if image_format == "PNG":
+            return {"compress_level": self.png_level.value(), "optimize": self.png_optimize.isChecked()}
+        return {
+            "quality": self.webp_quality.value(),
+            "lossless": self.webp_lossless.isChecked(),
+            "method": self.webp_method.value(),
+        }
+
+    def on_changed(self):
+        self.estimate_label.setText("Estimating...")
+        self.settings_changed.emit(self.image_format(), self.params())
+
+    def show_estimate(self, nbytes, seconds, quality=None):
+        if quality is None:
+            self.estimate_label.setText(f"~{format_size(nbytes)}, ~{seconds:.1f} s to encode")
+        else:
+            self.estimate_label.setText(f"Quality ~{quality}, ~{format_size(nbytes)}, ~{seconds:.1f} s to search")
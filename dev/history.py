@@ -0,0 +1,356 @@
+import mmap, tempfile, threading, zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+from pipeline import Adjustments, image_nbytes
+
+
+# How often the full image is kept. Undo replays at most this many operations
+# from the nearest checkpoint.
+CHECKPOINT_INTERVAL = 10
+MAX_UNDO_LEVELS = 500
+# RAM for checkpoints. The newest one stays as it is, older ones are zlib
+# compressed, and what does not fit after that goes to temp files.
+UNDO_MEMORY_BUDGET = 256 * 1024 * 1024
+COMPRESS_LEVEL = 1  # fastest zlib level, still 2-4x smaller on photos
+
+
+def rotate(image, angle):
+    return image.rotate(-angle, expand=True)
+
+
+def crop(image, box):
+    return image.crop(box)
+
+
+def resize(image, size):
+    return image.resize(size, Image.Resampling.LANCZOS)
+
+
+def mirror(image):
+    return ImageOps.mirror(image)
+
+
+@lru_cache(maxsize=8)
+def text_font(size):
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except IOError:
+        return ImageFont.load_default()
+
+
+def stamp_text(image, position, text, font_size=40, color="#000000"):
+    image = image.copy()
+    ImageDraw.Draw(image).text(position, text, font=text_font(font_size), fill=color)
+    return image
+
+
+def text_box(image, position, text, font_size=40, color="#000000"):
+    box = ImageDraw.Draw(image).textbbox(position, text, font=text_font(font_size))
+    return clip_box(box, image.size)
+
+
+def clip_box(box, size):
+    left, top = max(0, box[0]), max(0, box[1])
+    right, bottom = min(size[0], box[2]), min(size[1], box[3])
+    return (left, top, right, bottom) if left < right and top < bottom else None
+
+
+def adjust(image, adjustments):
+    # slider settings are applied by the render pipeline on top of the edits
+    return image
+
+
+OPERATIONS = {
+    "rotate": rotate,
+    "crop": crop,
+    "resize": resize,
+    "mirror": mirror,
+    "text": stamp_text,
+    "adjust": adjust,
+}
+
+# Operations that leave the pixels alone and only change render settings
+SETTING_OPERATIONS = {"adjust"}
+
+# Operations that only touch part of the image, with the box they touch given
+# the same arguments. Undo pastes the old pixels of that box back.
+LOCAL_OPERATIONS = {
+    "text": text_box,
+}
+
+
+@dataclass(frozen=True)
+class Operation:
+    name: str
+    params: tuple = ()
+
+    def apply(self, image):
+        return OPERATIONS[self.name](image, *self.params)
+
+    def box(self, image):
+        box = LOCAL_OPERATIONS.get(self.name)
+        return box(image, *self.params) if box else None
+
+
+# One checkpoint image, kept as is, zlib compressed or spilled to a temp file.
+# Compressing and spilling run on the store's thread while the GUI may restore
+# the same snapshot, so the slow work happens on local copies and only the
+# switch to the new state is under the lock.
+class Snapshot:
+    def __init__(self, image):
+        self.mode = image.mode
+        self.size = image.size
+        self.palette = image.getpalette() if image.mode in ("P", "PA") else None
+        self.image = image
+        self.data = None  # compressed pixels
+        self.file = None  # spilled pixels
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def usage(self):
+        # ("raw", "compressed" or "disk", bytes there)
+        with self.lock:
+            if self.image is not None:
+                return "raw", image_nbytes(self.image)
+            if self.data is not None:
+                return "compressed", len(self.data)
+            return "disk", self.file.seek(0, 2) if self.file is not None and not self.closed else 0
+
+    def nbytes(self):
+        # RAM held, spilled snapshots only cost disk
+        kind, nbytes = self.usage()
+        return 0 if kind == "disk" else nbytes
+
+    def compress(self):
+        image = self.image
+        if image is None or self.closed:
+            return
+        data = zlib.compress(image.tobytes(), COMPRESS_LEVEL)
+        with self.lock:
+            if self.image is image:
+                self.data, self.image = data, None
+
+    def spill(self):
+        with self.lock:
+            if self.file is not None or self.closed:
+                return
+            image, data = self.image, self.data
+        pixels = zlib.decompress(data) if data is not None else image.tobytes()
+        file = tempfile.TemporaryFile(prefix="filtroo_undo_")
+        file.write(pixels)
+        file.flush()
+        with self.lock:
+            if self.closed:
+                file.close()
+                return
+            self.file = file
+            self.image = self.data = None
+
+    def restore(self):
+        with self.lock:
+            image, data, file = self.image, self.data, self.file
+        if image is not None:
+            return image
+        if data is not None:
+            image = Image.frombytes(self.mode, self.size, zlib.decompress(data))
+        else:
+            # L, P, RGBA and the like use the mapped pages directly, RGB is copied out of them
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            image = Image.frombuffer(self.mode, self.size, mapped, "raw", self.mode, 0, 1)
+        if self.palette:
+            image.putpalette(self.palette)
+        return image
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.file is not None:
+                self.file.close()
+
+
+# Checkpoints by history position, within a RAM budget in bytes. Compressing
+# a large checkpoint takes seconds, so that and spilling happen on a thread of
+# the store's own; until it gets there the checkpoints stay in RAM as they are.
+class SnapshotStore:
+    def __init__(self, budget=UNDO_MEMORY_BUDGET):
+        self.budget = budget
+        self.snapshots = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="undo")
+
+    def indices(self):
+        return self.snapshots.keys()
+
+    def get(self, index):
+        snapshot = self.snapshots.get(index)
+        return snapshot.restore() if snapshot is not None else None
+
+    def put(self, index, image):
+        self.snapshots[index] = Snapshot(image)
+        self.executor.submit(self.fit, sorted(self.snapshots.items()))
+
+    def remove(self, index):
+        self.snapshots.pop(index).close()
+
+    def rebase(self, start):
+        # start becomes position 0, everything before it goes
+        for index in [index for index in self.snapshots if index < start]:
+            self.remove(index)
+        self.snapshots = {index - start: snapshot for index, snapshot in self.snapshots.items()}
+
+    def fit(self, snapshots):
+        # runs on the store's thread with the checkpoints as they were at put()
+        # only the newest checkpoint is kept uncompressed, undo lands near it most
+        *older, _ = [snapshot for _, snapshot in snapshots]
+        for snapshot in older:
+            snapshot.compress()
+        for snapshot in older:
+            if sum(snapshot.nbytes() for _, snapshot in snapshots if not snapshot.closed) <= self.budget:
+                break
+            snapshot.spill()
+
+    def wait(self):
+        # blocks until compressing and spilling so far are done
+        self.executor.submit(lambda: None).result()
+
+    def nbytes(self):
+        return sum(snapshot.nbytes() for snapshot in list(self.snapshots.values()))
+
+    def usage(self):
+        kinds = {"raw": [0, 0], "compressed": [0, 0], "disk": [0, 0]}
+        for snapshot in list(self.snapshots.values()):
+            kind, nbytes = snapshot.usage()
+            kinds[kind][0] += 1
+            kinds[kind][1] += nbytes
+        return kinds
+
+    def close(self):
+        # work not started yet is dropped, a running step sees its snapshot closed
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for snapshot in self.snapshots.values():
+            snapshot.close()
+        self.snapshots.clear()
+
+
+# Undo history as a list of operations on the opened image. position is how
+# many of them make up the current image, the rest can be redone. Full images
+# are only kept as checkpoints every checkpoint_interval operations; any other
+# state is rebuilt by replaying from the nearest checkpoint before it.
+# Checkpoints live in a SnapshotStore, which keeps them within memory_budget.
+# Local operations also keep the pixels they drew over, so undoing them is a
+# paste of that box rather than a replay.
+# Slider settings are operations too ("adjust"), so the list describes the whole
+# document: image is the result of the edits up to position, adjustments() the
+# settings the render pipeline applies to it. Undoing a setting moves position
+# and nothing else.
+class History:
+    def __init__(
+        self,
+        image,
+        checkpoint_interval=CHECKPOINT_INTERVAL,
+        max_levels=MAX_UNDO_LEVELS,
+        memory_budget=UNDO_MEMORY_BUDGET,
+        adjustments=Adjustments(),
+    ):
+        self.checkpoint_interval = checkpoint_interval
+        self.max_levels = max_levels
+        self.operations = []
+        self.patches = []  # per operation: (box, old pixels) for local ones, else None
+        self.position = 0
+        self.initial_adjustments = adjustments
+        self.checkpoints = SnapshotStore(memory_budget)
+        self.checkpoints.put(0, image)
+        self.image = image
+
+    def can_undo(self):
+        return self.position > 0
+
+    def can_redo(self):
+        return self.position < len(self.operations)
+
+    def push(self, operation):
+        box = operation.box(self.image)
+        patch = (box, self.image.crop(box)) if box else None
+        image = operation.apply(self.image)
+        # a new operation drops whatever could have been redone
+        del self.operations[self.position:]
+        del self.patches[self.position:]
+        for index in [index for index in self.checkpoints.indices() if index > self.position]:
+            self.checkpoints.remove(index)
+
+        self.operations.append(operation)
+        self.patches.append(patch)
+        self.position += 1
+        self.image = image
+        if self.edits_since_checkpoint() >= self.checkpoint_interval:
+            self.checkpoints.put(self.position, image)
+        self.trim()
+        return image
+
+    def edits_since_checkpoint(self):
+        # settings cost nothing to replay, only pixel edits count
+        start = max(self.checkpoints.indices())
+        return sum(operation.name not in SETTING_OPERATIONS for operation in self.operations[start:self.position])
+
+    def undo(self):
+        self.position -= 1
+        patch = self.patches[self.position]
+        if patch:
+            # a new image object all the same, render caches key on identity
+            box, pixels = patch
+            image = self.image.copy()
+            image.paste(pixels, box)
+            self.image = image
+        elif self.operations[self.position].name not in SETTING_OPERATIONS.union(LOCAL_OPERATIONS):
+            self.image = self.image_at(self.position)
+        # settings and local operations without a patch left the pixels as they were
+        return self.image
+
+    def redo(self):
+        operation = self.operations[self.position]
+        self.position += 1
+        image = self.checkpoints.get(self.position)
+        self.image = image if image is not None else operation.apply(self.image)
+        return self.image
+
+    def adjustments(self):
+        return self.adjustments_at(self.position)
+
+    def adjustments_at(self, position):
+        for operation in reversed(self.operations[:position]):
+            if operation.name == "adjust":
+                return operation.params[0]
+        return self.initial_adjustments
+
+    def image_at(self, position):
+        start = max(index for index in self.checkpoints.indices() if index <= position)
+        image = self.checkpoints.get(start)
+        for operation in self.operations[start:position]:
+            image = operation.apply(image)
+        return image
+
+    def trim(self):
+        excess = len(self.operations) - self.max_levels
+        if excess <= 0:
+            return
+        # the oldest kept state has to be a checkpoint, start from the first one past the excess
+        start = min((index for index in self.checkpoints.indices() if index >= excess), default=None)
+        if start is None:
+            start = self.position
+            self.checkpoints.put(start, self.image)
+        self.initial_adjustments = self.adjustments_at(start)
+        del self.operations[:start]
+        del self.patches[:start]
+        self.checkpoints.rebase(start)
+        self.position -= start
+
+    def usage(self):
+        usage = self.checkpoints.usage()
+        patches = [patch[1] for patch in self.patches if patch]
+        usage["patches"] = [len(patches), sum(image_nbytes(pixels) for pixels in patches)]
+        return usage
+
+    def close(self):
+        self.checkpoints.close()
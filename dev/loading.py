@@ -0,0 +1,70 @@
+import io, os
+from PIL import ExifTags, Image
+
+
+# IFD1 tags giving where the EXIF thumbnail JPEG sits inside the EXIF block
+THUMBNAIL_OFFSET = 0x0201
+THUMBNAIL_LENGTH = 0x0202
+
+
+def open_header(path):
+    # Reads only the file header: the full image size and the thumbnail embedded
+    # by the camera, if any. Takes milliseconds whatever the image size.
+    with Image.open(path) as image:
+        return image.size, embedded_thumbnail(image)
+
+
+def embedded_thumbnail(image):
+    exif = image.info.get("exif")
+    if not exif:
+        return None
+    try:
+        ifd1 = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        start = ifd1[THUMBNAIL_OFFSET] + 6  # offsets count from the TIFF header, after "Exif\0\0"
+        thumbnail = Image.open(io.BytesIO(exif[start:start + ifd1[THUMBNAIL_LENGTH]]))
+        thumbnail.load()
+    except (KeyError, OSError, ValueError, SyntaxError):
+        return None
+    return thumbnail
+
+
+def open_preview(path, size):
+    # Returns a quickly decoded preview at least size big and the full image size.
+    # JPEG decodes at 1/2, 1/4 or 1/8 scale straight from the DCT coefficients,
+    # which skips most of the work; other formats get no preview.
+    image = Image.open(path)
+    full_size = image.size
+    if image.format != "JPEG" or (image.width <= size[0] and image.height <= size[1]):
+        image.close()
+        return None, full_size
+    image.draft("RGB", size)
+    image.load()
+    return image, full_size
+
+
+# File wrapper reporting how far the decoder has read, Pillow reads the pixel
+# data in blocks while it decodes so this is the decode progress
+class ProgressReader:
+    def __init__(self, file, progress):
+        self.file = file
+        self.size = max(1, os.fstat(file.fileno()).st_size)
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.progress(self.file.tell() / self.size)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def decode(path, progress=None):
+    if progress is None:
+        image = Image.open(path)
+        image.load()
+        return image
+    with open(path, "rb") as file:
+        image = Image.open(ProgressReader(file, progress))
+        image.load()
+    return image
@@ -1,14 +1,27 @@
-import sys, io, time
+import sys, time, math, multiprocessing
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtGui import QIcon, QImage, QPixmap, QTransform
 from PyQt5.QtCore import QSize, QBuffer, Qt
 from PyQt5.QtWidgets import QFileDialog, QColorDialog, QDialog, QLabel
 from PyQt5.QtWidgets import QGraphicsDropShadowEffect, QApplication
 from PyQt5.QtWidgets import QMessageBox, QInputDialog, QActionGroup
-from PIL import Image, ImageEnhance, ImageChops, ImageQt, ImageFilter, ImageOps, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageQt
 import PIL.ImageQt as ImageQt
 from ui2 import Ui_MainWindow
 from about import Ui_Dialog
+from bridge import pil_to_pixmap
+from pipeline import Adjustments, StagedPipeline, BACKENDS
+from workers import RenderScheduler, ImageLoader, ImageSaver, Estimator
+from export import EXTENSIONS, ExportDialog, has_extension, sample_image
+from loading import open_header
+from timings import tracer, format_frame
+from viewer import TiledImageView
+from history import History, Operation
+import pipeline
+try:
+    import numpy_backend  # registers the "numpy" render backend
+except ImportError:
+    numpy_backend = None
 import res
 
 
@@ -20,36 +33,53 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.initialize_properties()
         self.setup_ui()
+        self.setup_render_scheduler()
+        self.setup_image_loader()
+        self.setup_image_saver()
+        self.setup_export_action()
+        self.setup_backend_menu()
+        self.setup_timing_action()
+        self.setup_undo_memory_action()
         self.setup_connections()
         self.setup_collapsible_panels()
         self.add_shadows()
         
 
     def initialize_properties(self):
-        self.original_image = None
+        self.base_image = None  # decoded image with the geometric edits, None while loading
         self.working_pil_image = None
         self.original_pixmap = None
         self.unsaved_img = None
         self.current_file_path = None
+        self.load_generation = 0  # tags decodes so a superseded open is ignored
         self.enabled_cropping = False
         self.zoom_factor = 1.0
+        self.image_size = QtCore.QSize()  # full resolution size of the displayed image
+        self.use_proxy = True  # render previews at display resolution
+        self.render_cache_budget = 512 * 1024 * 1024  # bytes of cached stage outputs
+        self.proxy_level = 0  # preview rendered at 1 / 2**proxy_level
         self.min_zoom = 0.1
         self.max_zoom = 10.0
         self.zoom_step = 0.25
+        self.zoom_settle_delay = 150  # ms without zoom changes before the smooth pass
         self.panning = False
         self.last_pan_point = QtCore.QPoint()
         self.rubber_band = None
         self.crop_origin = None
         self.rect_moved = False
-        self.undo_stack = []
-        self.redo_stack = []
-        self.max_stack_size = 5
+        self.history = None  # operations applied to base_image, see history.py
+        self.undo_memory_budget = 256 * 1024 * 1024  # bytes of RAM for undo checkpoints
+        self.adjustment_commit_delay = 400  # ms of slider quiet before the settings become an undo step
         self.max_viewport_size = QtCore.QSize(800, 600)
         self.current_tool = None  # 'text' or 'crop'
 
     def setup_ui(self):
-        self.ui.imageLabel = self.ui.scrollArea_viewport.findChild(QLabel, "imageLabel")
-        self.ui.imageLabel.setAlignment(QtCore.Qt.AlignCenter)
+        # the designer QLabel would hold the whole zoomed pixmap, the tiled view
+        # only draws what is visible
+        label = self.ui.scrollArea_viewport.findChild(QLabel, "imageLabel")
+        self.image_view = TiledImageView(self.ui.scrollAreaWidgetContents_viewport)
+        self.ui.horizontalLayout_viewport.replaceWidget(label, self.image_view)
+        label.deleteLater()
 
         self.ui.scrollArea_viewport.setAlignment(QtCore.Qt.AlignCenter)
         self.ui.scrollArea_viewport.setHorizontalScrollBarPolicy(
@@ -59,6 +89,103 @@ class MainWindow(QtWidgets.QMainWindow):
             QtCore.Qt.ScrollBarAlwaysOff
         )
 
+    def setup_render_scheduler(self):
+        self.render_pipeline = StagedPipeline(self.render_cache_budget)
+        self.render_scheduler = RenderScheduler(self.render_pipeline, self)
+        self.render_scheduler.rendered.connect(self.on_image_rendered)
+        self.render_scheduler.idle.connect(self.on_render_idle)
+
+    def setup_image_loader(self):
+        self.image_loader = ImageLoader(self)
+        self.image_loader.previewed.connect(self.on_image_previewed)
+        self.image_loader.progress.connect(self.on_load_progress)
+        self.image_loader.loaded.connect(self.on_image_loaded)
+        self.image_loader.failed.connect(self.on_image_load_failed)
+
+        self.load_progress = QtWidgets.QProgressBar()
+        self.load_progress.setRange(0, 100)
+        self.load_progress.setMaximumWidth(160)
+        self.load_progress.setFormat("Loading %p%")
+        self.load_progress.hide()
+        self.ui.statusbar.addPermanentWidget(self.load_progress)
+
+    def setup_image_saver(self):
+        self.image_saver = ImageSaver(self.render_pipeline, self)
+        self.image_saver.progress.connect(self.on_save_progress)
+        self.image_saver.finished.connect(self.on_save_finished)
+
+        self.save_progress = QtWidgets.QProgressBar()
+        self.save_progress.setRange(0, 0)  # encoders do not know the final size, just show activity
+        self.save_progress.setMaximumWidth(100)
+        self.save_progress.hide()
+        self.save_cancel_button = QtWidgets.QPushButton("Cancel save")
+        self.save_cancel_button.clicked.connect(self.image_saver.cancel)
+        self.save_cancel_button.hide()
+        self.ui.statusbar.addPermanentWidget(self.save_progress)
+        self.ui.statusbar.addPermanentWidget(self.save_cancel_button)
+
+    def setup_export_action(self):
+        self.export_dialog = None
+        self.estimator = Estimator(self)
+        self.estimator.estimated.connect(self.on_export_estimated)
+
+        self.export_action = QtWidgets.QAction("Export...", self)
+        self.export_action.triggered.connect(self.export_image)
+        actions = self.ui.menuFile.actions()
+        self.ui.menuFile.insertAction(actions[actions.index(self.ui.actionSave_as) + 1], self.export_action)
+
+    def setup_backend_menu(self):
+        labels = {"pillow": "Pillow", "numpy": "NumPy"}
+        menu = self.ui.menuEdit.addMenu("Render backend")
+        self.backend_group = QActionGroup(self)
+        for name in BACKENDS:
+            action = menu.addAction(labels.get(name, name))
+            action.setCheckable(True)
+            action.setChecked(name == self.render_pipeline.backend)
+            action.triggered.connect(lambda checked, name=name: self.set_backend(name))
+            self.backend_group.addAction(action)
+
+    def setup_timing_action(self):
+        self.ui.menuEdit.addSeparator()
+        self.timing_action = self.ui.menuEdit.addAction("Trace render timings")
+        self.timing_action.setCheckable(True)
+        self.timing_action.toggled.connect(self.set_timing_enabled)
+
+    def setup_undo_memory_action(self):
+        self.undo_memory_action = self.ui.menuEdit.addAction("Undo memory...")
+        self.undo_memory_action.triggered.connect(self.show_undo_memory)
+
+    def show_undo_memory(self):
+        if not self.history:
+            self.show_info("Undo memory", "No image open")
+            return
+        usage = self.history.usage()
+        in_memory = usage["raw"][1] + usage["compressed"][1] + usage["patches"][1]
+        lines = [
+            f"Undo levels: {self.history.position} (redo: {len(self.history.operations) - self.history.position})",
+            f"Memory: {in_memory / 2**20:.1f} MB of {self.undo_memory_budget / 2**20:.0f} MB",
+        ]
+        for kind in ("raw", "compressed", "disk"):
+            count, nbytes = usage[kind]
+            lines.append(f"{kind.capitalize()} checkpoints: {count}, {nbytes / 2**20:.1f} MB")
+        count, nbytes = usage["patches"]
+        lines.append(f"Local edit patches: {count}, {nbytes / 2**10:.0f} KB")
+        self.show_info("Undo memory", "\n".join(lines))
+
+    def set_timing_enabled(self, enabled):
+        tracer.enabled = enabled
+        tracer.take_frame()
+        if enabled:
+            self.ui.statusbar.showMessage(f"Tracing render timings to {tracer.path}")
+        else:
+            tracer.flush()
+            self.ui.statusbar.showMessage("Render timing off")
+
+    def set_backend(self, name):
+        self.render_pipeline.set_backend(name)
+        self.update_full_image()
+        self.ui.statusbar.showMessage(f"Render backend: {name}")
+
     def setup_connections(self):
         # Menu actions
         self.ui.actionOpen.triggered.connect(self.open_file)
@@ -77,31 +204,42 @@ class MainWindow(QtWidgets.QMainWindow):
         # self.ui.zoomInButton.clicked.connect(self.zoom_in)
         # self.ui.zoomOutButton.clicked.connect(self.zoom_out)
         self.ui.zoomSlider.valueChanged.connect(self.zoom)
+        self.ui.zoomSlider.sliderReleased.connect(self.settle_zoom)
+        # one smooth pass once zooming stops, also for the wheel and the keyboard
+        self.zoom_settle_timer = QtCore.QTimer(self)
+        self.zoom_settle_timer.setSingleShot(True)
+        self.zoom_settle_timer.setInterval(self.zoom_settle_delay)
+        self.zoom_settle_timer.timeout.connect(self.settle_zoom)
 
         # Right toolbar---------------------------------------------------------------------
         # Color
-        self.ui.r_slider.valueChanged.connect(self.update_full_image)
-        self.ui.g_slider.valueChanged.connect(self.update_full_image)
-        self.ui.b_slider.valueChanged.connect(self.update_full_image)
+        self.ui.r_slider.valueChanged.connect(self.on_adjustments_changed)
+        self.ui.g_slider.valueChanged.connect(self.on_adjustments_changed)
+        self.ui.b_slider.valueChanged.connect(self.on_adjustments_changed)
         
         self.ui.reset_color_button.clicked.connect(self.reset_colors)
         
         # Enhancements
-        self.ui.brightness_slider.valueChanged.connect(self.update_full_image)
-        self.ui.contrast_slider.valueChanged.connect(self.update_full_image)
-        self.ui.sharpness_slider.valueChanged.connect(self.update_full_image)
-        self.ui.saturation_slider.valueChanged.connect(self.update_full_image)
+        self.ui.brightness_slider.valueChanged.connect(self.on_adjustments_changed)
+        self.ui.contrast_slider.valueChanged.connect(self.on_adjustments_changed)
+        self.ui.sharpness_slider.valueChanged.connect(self.on_adjustments_changed)
+        self.ui.saturation_slider.valueChanged.connect(self.on_adjustments_changed)
 
         self.ui.reset_enhance_button.clicked.connect(self.reset_enhancements)
         # Img filters
-        self.ui.actionBlur.toggled.connect(self.update_full_image)
-        self.ui.actionContour.toggled.connect(self.update_full_image)
-        self.ui.actionDetail.toggled.connect(self.update_full_image)
-        self.ui.actionEdge_Enhance.toggled.connect(self.update_full_image)
-        self.ui.actionSharpen.toggled.connect(self.update_full_image)
-        self.ui.actionEmboss.toggled.connect(self.update_full_image)
-        self.ui.actionFind_Edhes.toggled.connect(self.update_full_image)
-        self.ui.actionSmooth.toggled.connect(self.update_full_image)
+        self.ui.actionBlur.toggled.connect(self.on_adjustments_changed)
+        self.ui.actionContour.toggled.connect(self.on_adjustments_changed)
+        self.ui.actionDetail.toggled.connect(self.on_adjustments_changed)
+        self.ui.actionEdge_Enhance.toggled.connect(self.on_adjustments_changed)
+        self.ui.actionSharpen.toggled.connect(self.on_adjustments_changed)
+        self.ui.actionEmboss.toggled.connect(self.on_adjustments_changed)
+        self.ui.actionFind_Edhes.toggled.connect(self.on_adjustments_changed)
+        self.ui.actionSmooth.toggled.connect(self.on_adjustments_changed)
+        # a slider drag is one undo step: settings are recorded once they stop changing
+        self.adjustment_commit_timer = QtCore.QTimer(self)
+        self.adjustment_commit_timer.setSingleShot(True)
+        self.adjustment_commit_timer.setInterval(self.adjustment_commit_delay)
+        self.adjustment_commit_timer.timeout.connect(self.commit_adjustments)
         
         #Img Actions
         # Event filters
@@ -135,126 +273,260 @@ class MainWindow(QtWidgets.QMainWindow):
         if not file_path:
             return
 
-        self.original_image = Image.open(file_path)
+        # show the embedded thumbnail right away, a screen sized preview and the
+        # full image follow from the loader thread
+        try:
+            full_size, thumbnail = open_header(file_path)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            QMessageBox.critical(self, "Error", f"Failed to open image:\n{e}")
+            return
+
         self.current_file_path = file_path  # 🔹 зберігаємо шлях
-        self.base_image = self.original_image.copy()
-        self.working_pil_image = self.original_image.copy()
-        self.original_pixmap = self.pil_image_to_pixmap(self.working_pil_image)
+        self.base_image = None
+        if self.history:
+            self.history.close()
+        self.history = None
+        self.image_size = QtCore.QSize(*full_size)
+        self.proxy_level = 0
         self.zoom_factor = 1.0
         self.ui.choosefileLabel.setParent(None) # usuń tekst "Choose File"
+        self.working_pil_image = thumbnail
+        self.original_pixmap = self.pil_image_to_pixmap(thumbnail)
+        self.image_view.set_image(self.original_pixmap, self.image_size)
+        self.update_display()
+
+        self.set_editing_enabled(False)
+        self.load_progress.setValue(0)
+        self.load_progress.show()
+        self.load_generation += 1
+        self.render_scheduler.drop_pending()
+        self.image_loader.request(file_path, (self.load_generation, file_path), self.preview_size())
+        self.ui.statusbar.showMessage(f"Loading: {file_path}")
+
+    def preview_size(self):
+        size = QApplication.primaryScreen().size()
+        return (size.width(), size.height())
+
+    def set_editing_enabled(self, enabled):
+        # nothing to edit or save until the full image has been decoded
+        actions = [
+            self.ui.actionCrop, self.ui.actionRotate, self.ui.actionResize, self.ui.actionMirror,
+            self.ui.actionTextTool, self.ui.actionUndo, self.ui.actionRedo,
+            self.ui.actionSave, self.ui.actionSave_as,
+        ]
+        for action in actions + list(self.filter_actions().values()):
+            action.setEnabled(enabled)
+        self.ui.scrollArea.setEnabled(enabled)
+
+    def on_image_previewed(self, image, qimage, tag):
+        generation, _ = tag
+        if generation != self.load_generation or self.base_image is not None:
+            return
+        self.working_pil_image = image
+        self.original_pixmap = QPixmap.fromImage(qimage)
         self.update_display()
+
+    def on_load_progress(self, percent, tag):
+        generation, _ = tag
+        if generation == self.load_generation:
+            self.load_progress.setValue(percent)
+
+    def on_image_loaded(self, image, tag):
+        generation, file_path = tag
+        if generation != self.load_generation:
+            return
+        self.load_progress.hide()
+        self.set_editing_enabled(True)
+
+        # edits make new images, so the decoded one can be shared without copies
+        self.base_image = image
+        self.history = History(
+            self.base_image, memory_budget=self.undo_memory_budget, adjustments=self.current_adjustments()
+        )
+        self.image_size = QtCore.QSize(*image.size)
+        self.update_full_image()
         self.ui.statusbar.showMessage(f"Opened: {file_path}")
 
+    def on_image_load_failed(self, error, tag):
+        generation, file_path = tag
+        if generation == self.load_generation:
+            self.load_progress.hide()
+            self.ui.statusbar.showMessage(f"Failed to open: {file_path}")
+            QMessageBox.critical(self, "Error", f"Failed to open image:\n{error}")
+
     def pil_image_to_pixmap(self, pil_image):
         if not pil_image:
             return QtGui.QPixmap()
 
-        if pil_image.mode != "RGBA":
-            pil_image = pil_image.convert("RGBA")
+        with tracer.span("to QPixmap"):
+            return pil_to_pixmap(pil_image)
+
+    def filter_actions(self):
+        return {
+            "blur": self.ui.actionBlur,
+            "contour": self.ui.actionContour,
+            "detail": self.ui.actionDetail,
+            "edge_enhance": self.ui.actionEdge_Enhance,
+            "sharpen": self.ui.actionSharpen,
+            "emboss": self.ui.actionEmboss,
+            "find_edges": self.ui.actionFind_Edhes,
+            "smooth": self.ui.actionSmooth,
+        }
+
+    def current_adjustments(self):
+        return Adjustments(
+            red=self.ui.r_slider.value(),
+            green=self.ui.g_slider.value(),
+            blue=self.ui.b_slider.value(),
+            brightness=self.ui.brightness_slider.value(),
+            contrast=self.ui.contrast_slider.value(),
+            sharpness=self.ui.sharpness_slider.value(),
+            saturation=self.ui.saturation_slider.value(),
+            filters=tuple(
+                name for name, action in self.filter_actions().items() if action.isChecked()
+            ),
+        )
 
+    def set_adjustments(self, adjustments):
+        # show settings from the history without recording them again
+        sliders = {
+            self.ui.r_slider: adjustments.red,
+            self.ui.g_slider: adjustments.green,
+            self.ui.b_slider: adjustments.blue,
+            self.ui.brightness_slider: adjustments.brightness,
+            self.ui.contrast_slider: adjustments.contrast,
+            self.ui.sharpness_slider: adjustments.sharpness,
+            self.ui.saturation_slider: adjustments.saturation,
+        }
+        for slider, value in sliders.items():
+            slider.blockSignals(True)
+            slider.setValue(value)
+            slider.blockSignals(False)
+        for name, action in self.filter_actions().items():
+            action.blockSignals(True)
+            action.setChecked(name in adjustments.filters)
+            action.blockSignals(False)
+
+    def on_adjustments_changed(self):
+        self.update_full_image()
+        if self.history:
+            self.adjustment_commit_timer.start()
 
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format="PNG")
-        pixmap = QtGui.QPixmap()
-        pixmap.loadFromData(buffer.getvalue())
-        return pixmap
+    def commit_adjustments(self):
+        self.adjustment_commit_timer.stop()
+        adjustments = self.current_adjustments()
+        if self.history and adjustments != self.history.adjustments():
+            self.history.push(Operation("adjust", (adjustments,)))
 
     def apply_all_adjustments(self, image):
-        image = self.update_colors(image)
-        image = self.update_enhancements(image)
-        image = self.update_filters(image)
-        return image
+        return pipeline.apply_all_adjustments(image, self.current_adjustments(), self.render_pipeline.backend)
 
     def update_full_image(self):
-        if not hasattr(self, 'base_image') or self.base_image is None:
+        if self.base_image is None:
             return
 
-        image = self.base_image.convert("RGB")
+        # geometric edits change the size right away, not when their render
+        # arrives, so the fit zoom and clicks in between use the new geometry
+        size = QtCore.QSize(*self.base_image.size)
+        if size != self.image_size:
+            self.image_size = size
+            self.update_display()
 
-        image = self.apply_all_adjustments(image)
+        # rendered on the worker thread, result arrives in on_image_rendered
+        level = self.required_proxy_level()
+        self.render_scheduler.request(
+            self.base_image, self.current_adjustments(), (self.load_generation, level, self.base_image.size), level
+        )
 
-        self.working_pil_image = image.copy()
-        self.original_pixmap = self.pil_image_to_pixmap(image)
+    def on_image_rendered(self, image, qimage, tag):
+        generation, level, size = tag
+        if generation != self.load_generation:
+            return  # a render of the previous image, finished after another one was opened
+        if QtCore.QSize(*size) != self.image_size:
+            return  # rendered before a crop, rotate or resize, the render after it is on its way
+        self.proxy_level = level
+        self.working_pil_image = image
+        with tracer.span("to QPixmap"):
+            self.original_pixmap = QPixmap.fromImage(qimage)
         self.update_display()
 
-    def update_colors(self, image):
-        red_factor = self.ui.r_slider.value() / 100
-        green_factor = self.ui.g_slider.value() / 100
-        blue_factor = self.ui.b_slider.value() / 100
+        if tracer.enabled:
+            self.ui.statusbar.showMessage(format_frame(tracer.take_frame()))
+            tracer.flush()
+
+    def required_proxy_level(self):
+        # largest power of two reduction that still has at least one pixel per screen pixel
+        if not self.use_proxy or self.zoom_factor >= 1:
+            return 0
+        return int(math.floor(math.log2(1 / self.zoom_factor)))
+
+    def on_render_idle(self, skipped):
+        if skipped:
+            self.ui.statusbar.showMessage(f"Skipped {skipped} outdated renders", 3000)
+
+    def save_source(self):
+        # (image, adjustments to render it with or None when it is final)
+        # a render may still be in flight or show a preview, save what the sliders show at full resolution
+        if self.render_scheduler.is_idle() and self.proxy_level == 0:
+            return self.working_pil_image, None
+        return self.base_image, self.current_adjustments()
+
+    def start_save(self, file_path, params=None, export=False):
+        # base_image and the adjustments are never modified in place, editing can go on meanwhile
+        image, adjustments = self.save_source()
+        self.image_saver.request(image, adjustments, file_path, params, (self.load_generation, file_path, export))
+        self.save_progress.show()
+        self.save_cancel_button.show()
+        self.ui.statusbar.showMessage(f"Saving: {file_path}")
+
+    def on_save_progress(self, written, tag):
+        _, file_path, _ = tag
+        self.ui.statusbar.showMessage(f"Saving: {file_path} ({written / 2**20:.1f} MB written)")
+
+    def on_save_finished(self, status, error, tag):
+        generation, file_path, export = tag
+        if not self.image_saver.is_busy():
+            self.save_progress.hide()
+            self.save_cancel_button.hide()
+
+        if status == "saved":
+            if generation == self.load_generation and not export:
+                self.current_file_path = file_path  # оновлюємо шлях
+            self.ui.statusbar.showMessage(f"Saved: {file_path}")
+        elif status == "cancelled":
+            self.ui.statusbar.showMessage(f"Save cancelled: {file_path}")
+        else:
+            QMessageBox.critical(self, "Error", f"Failed to save image:\n{error}")
 
-        r, g, b = image.split()
-        r = r.point(lambda i: max(0, min(255, int(i * red_factor))))
-        g = g.point(lambda i: max(0, min(255, int(i * green_factor))))
-        b = b.point(lambda i: max(0, min(255, int(i * blue_factor))))
-        return Image.merge("RGB", (r, g, b))
+    def update_colors(self, image):
+        return pipeline.update_colors(image, self.current_adjustments())
 
     def update_enhancements(self, image):
-        brightness_value = self.ui.brightness_slider.value() / 20
-        contrast_value = self.ui.contrast_slider.value() / 20
-        sharpness_value = self.ui.sharpness_slider.value() / 20
-        saturation_value = self.ui.saturation_slider.value() / 20
-
-        image = ImageEnhance.Brightness(image).enhance(2 ** brightness_value)
-        image = ImageEnhance.Contrast(image).enhance(3 ** contrast_value)
-        image = ImageEnhance.Sharpness(image).enhance(3 ** sharpness_value)
-        image = ImageEnhance.Color(image).enhance(3 ** saturation_value)
-
-        return image
+        return pipeline.update_enhancements(image, self.current_adjustments())
 
     def update_filters(self, image):
-        filter_map = {
-            self.ui.actionBlur: ImageFilter.BLUR,
-            self.ui.actionContour: ImageFilter.CONTOUR,
-            self.ui.actionDetail: ImageFilter.DETAIL,
-            self.ui.actionEdge_Enhance: ImageFilter.EDGE_ENHANCE,
-            self.ui.actionSharpen: ImageFilter.SHARPEN,
-            self.ui.actionEmboss: ImageFilter.EMBOSS,
-            self.ui.actionFind_Edhes: ImageFilter.FIND_EDGES,
-            self.ui.actionSmooth: ImageFilter.SMOOTH,
-        }
-
-        for action, pil_filter in filter_map.items():
-            if action.isChecked():
-                image = image.filter(pil_filter)
-
-        return image
+        return pipeline.update_filters(image, self.current_adjustments())
     
     def reset_enhancements(self):
         self.ui.brightness_slider.setValue(0)
         self.ui.contrast_slider.setValue(0)
         self.ui.sharpness_slider.setValue(0)
         self.ui.saturation_slider.setValue(0)
-
-        try:
-            self.current_image = self.original_image.copy()
-            self.update_display()
-            self.ui.statusbar.showMessage("Enchancements reseted")
-
-        except Exception as e:
-            print(f"Error: {e}")
-            return
+        # the sliders re-render the image themselves
+        self.ui.statusbar.showMessage("Enchancements reseted")
 
     def reset_colors(self):
         self.ui.r_slider.setValue(100)
         self.ui.g_slider.setValue(100)
         self.ui.b_slider.setValue(100)
-
-        try:
-            self.current_image = self.original_image.copy()
-            self.update_display()
-            self.ui.statusbar.showMessage("Colors reseted")
-
-        except Exception as e:
-            print(f"Error: {e}")
-            return
+        # the sliders re-render the image themselves
+        self.ui.statusbar.showMessage("Colors reseted")
 
     def rotate_img(self):
         angle, ok = self.input_dialog(QInputDialog.DoubleInput, "Rotate Image", "Enter rotation angle (0-360):", 0,
                                       0, 360, 0)
         if ok:
-            self.push_undo_state()
-            self.base_image = self.base_image.rotate(-angle, expand=True)
-            self.update_full_image()
+            self.apply_operation(Operation("rotate", (angle,)))
             self.ui.statusbar.showMessage(f"Image rotated: {angle}")
 
     def input_dialog(self, type, title, text, decimals=1, min=0, max=360, val=0, items=None):
@@ -296,51 +568,90 @@ class MainWindow(QtWidgets.QMainWindow):
         msg_box.exec_()
 
     def resize_img(self):
+        if not self.base_image:
+            return
+
         factor, ok = self.input_dialog(QInputDialog.DoubleInput, "Resize Image", "Resize factor (e.g. 2 = half size):", 
                           2, 0.1, 1000, 1.0)
         if ok:
-            self.push_undo_state()
             old_size = self.base_image.size
             new_size = (int(old_size[0] / factor), int(old_size[1] / factor))
 
-            self.base_image = self.base_image.resize(new_size, Image.Resampling.LANCZOS)
+            self.apply_operation(Operation("resize", (new_size,)))
 
             self.show_info("Resize Info", f"Original size: {old_size[0]}x{old_size[1]}\n" + 
                            f"New size: {new_size[0]}x{new_size[1]}")
 
-            self.update_full_image()
-
     def mirror_img(self):
         if not self.base_image:
             return
 
-        self.push_undo_state()
-        self.base_image = ImageOps.mirror(self.base_image)
-        self.update_full_image()
+        self.apply_operation(Operation("mirror"))
         self.ui.statusbar.showMessage("Image mirrored horizontally")
 
 
 
     def save_image(self):
+        if not self.base_image:
+            return
         if not self.current_file_path:
             self.save_image_as()
             return
 
-        try:
-            self.working_pil_image.save(self.current_file_path)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to save image:\n{e}")
+        self.start_save(self.current_file_path)
 
     def save_image_as(self):
+        if not self.base_image:
+            return
+
         file_path, _ = QFileDialog.getSaveFileName(self, "Save Image As", "", "Images (*.png *.jpg *.bmp)")
         if not file_path:
             return
 
-        try:
-            self.working_pil_image.save(file_path)
-            self.current_file_path = file_path  # оновлюємо шлях
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Failed to save image:\n{e}")
+        self.start_save(file_path)
+
+    def export_image(self):
+        if not self.base_image:
+            return
+
+        # the estimate encodes a small sample with the same adjustments as the export
+        image, adjustments = self.save_source()
+        sample, scale = sample_image(image)
+        if adjustments is not None:
+            sample = pipeline.apply_all_adjustments(sample, adjustments, self.render_pipeline.backend)
+
+        dialog = ExportDialog(self)
+        dialog.settings_changed.connect(
+            lambda image_format, params: self.estimator.request(sample, scale, image_format, params, dialog)
+        )
+        self.export_dialog = dialog
+        dialog.on_changed()
+        accepted = dialog.exec_() == QDialog.Accepted
+        self.export_dialog = None
+        if not accepted:
+            return
+
+        image_format = dialog.image_format()
+        # the file dialog adds the extension itself, so the overwrite prompt
+        # is about the file that really gets written
+        file_dialog = QFileDialog(self, "Export Image", "", f"{image_format} (*{EXTENSIONS[image_format]})")
+        file_dialog.setAcceptMode(QFileDialog.AcceptSave)
+        file_dialog.setDefaultSuffix(EXTENSIONS[image_format][1:])
+        if file_dialog.exec_() != QDialog.Accepted:
+            return
+        file_path = file_dialog.selectedFiles()[0]
+        if not has_extension(file_path, image_format):
+            QMessageBox.critical(self, "Error", f"Cannot export {image_format} to:\n{file_path}\nUse a {EXTENSIONS[image_format]} name.")
+            return
+        self.start_save(file_path, dialog.params(), export=True)
+
+    def on_export_estimated(self, result, error, dialog):
+        if dialog is not self.export_dialog:
+            return
+        if result is None:
+            dialog.estimate_label.setText(f"Cannot encode: {error}")
+        else:
+            dialog.show_estimate(*result)
 
     # def zoom_in(self):
     #     self.zoom_factor = min(self.zoom_factor + self.zoom_step, self.max_zoom)
@@ -370,42 +681,19 @@ class MainWindow(QtWidgets.QMainWindow):
         text, ok = self.input_dialog(QInputDialog.TextInput, "Add text", "Type text:")
 
         if ok and text:
-            self.push_undo_state()
-            draw = ImageDraw.Draw(self.working_pil_image)
-
-            font_size = 40
-            try:
-                font = ImageFont.truetype("arial.ttf", font_size)
-            except IOError:
-                font = ImageFont.load_default()
-            draw.text(coords, text, font=font, fill=QtGui.QColor('black').name())
-
-            self.push_undo_state()
-            self.base_image = self.working_pil_image.copy()
-            self.original_pixmap = self.pil_image_to_pixmap(self.working_pil_image)
-            self.update_display()
+            self.apply_operation(Operation("text", (coords, text, 40, QtGui.QColor('black').name())))
 
     def _get_image_coords(self, pos_in_label):
         if not self.original_pixmap or self.original_pixmap.isNull():
             return None
-        pixmap_size = self.ui.imageLabel.pixmap().size()
-        image_size = self.working_pil_image.size
-
-        if pixmap_size.width() == 0 or pixmap_size.height() == 0:
-            return None
-        scale_x = image_size[0] / pixmap_size.width()
-        scale_y = image_size[1] / pixmap_size.height()
-
-        img_x = int(pos_in_label.x() * scale_x)
-        img_y = int(pos_in_label.y() * scale_y)
-        return (img_x, img_y)
+        return self.image_view.to_image(pos_in_label)
 
     def zoom(self, value):
         if not self.original_pixmap or self.original_pixmap.isNull():
             return
         max_height, max_width = self.size().height() * 0.8, self.size().width() * 0.8
-        vertical_ratio = max_height / self.original_pixmap.height()
-        horizontal_ratio = max_width / self.original_pixmap.width()
+        vertical_ratio = max_height / self.image_size.height()
+        horizontal_ratio = max_width / self.image_size.width()
         if vertical_ratio >= horizontal_ratio:
             self.zoom_factor = vertical_ratio
         else:
@@ -413,36 +701,51 @@ class MainWindow(QtWidgets.QMainWindow):
         self.zoom_factor *= value / 100
         percent = self.zoom_factor * 100
         self.ui.zoomLabel.setText(f"{int(percent)}%")
+        # fast unfiltered tiles until zooming stops, then settle_zoom redraws smoothly
+        self.image_view.set_smooth(False)
+        self.zoom_settle_timer.start()
         self.update_display()
 
-    # ================ Undo/Redo Operations =================
-    def push_undo_state(self):
-        if not self.base_image:
+    def settle_zoom(self):
+        self.zoom_settle_timer.stop()
+        if self.ui.zoomSlider.isSliderDown():
             return
+        self.image_view.set_smooth(True)
+        # zooming out is served by the pyramid, only zooming in needs a sharper render
+        if self.required_proxy_level() < self.proxy_level:
+            self.update_full_image()
 
-        self.undo_stack.append(self.base_image.copy())
-        if len(self.undo_stack) > self.max_stack_size:
-            self.undo_stack.pop(0)
-        self.redo_stack.clear()
+    # ================ Undo/Redo Operations =================
+    def apply_operation(self, operation):
+        # geometric edits go through the history so they can be replayed on undo
+        if not self.history:
+            return
+        self.commit_adjustments()
+        self.base_image = self.history.push(operation)
+        self.update_full_image()
 
     def undo(self):
-        if not self.undo_stack:
+        if self.history:
+            self.commit_adjustments()
+        if not self.history or not self.history.can_undo():
             self.ui.statusbar.showMessage("Nothing to undo")
             return
 
-        self.redo_stack.append(self.base_image.copy())
-        self.base_image = self.undo_stack.pop()
+        self.base_image = self.history.undo()
+        self.set_adjustments(self.history.adjustments())
         
         self.update_full_image()
         self.ui.statusbar.showMessage("Undo successful")
 
     def redo(self):
-        if not self.redo_stack:
+        if self.history:
+            self.commit_adjustments()
+        if not self.history or not self.history.can_redo():
             self.ui.statusbar.showMessage("Nothing to redo")
             return
             
-        self.undo_stack.append(self.base_image.copy())        
-        self.base_image = self.redo_stack.pop()
+        self.base_image = self.history.redo()
+        self.set_adjustments(self.history.adjustments())
 
         self.update_full_image()
         self.ui.statusbar.showMessage("Redo successful")
@@ -451,14 +754,9 @@ class MainWindow(QtWidgets.QMainWindow):
     def update_display(self):
         if not self.original_pixmap or self.original_pixmap.isNull():
             return
-        scaled_size = self.original_pixmap.size() * self.zoom_factor
-        scaled_pixmap = self.original_pixmap.scaled(
-            scaled_size, QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation
-        )
-
-        self.ui.imageLabel.setPixmap(scaled_pixmap)
-        # viewport_size = scaled_size.boundedTo(self.max_viewport_size)
-        self.ui.imageLabel.resize(scaled_pixmap.size())
+        scaled_size = self.image_size * self.zoom_factor
+        self.image_view.set_image(self.original_pixmap, self.image_size)
+        self.image_view.set_display_size(scaled_size)
 
         # Set scroll area size
         self.ui.scrollArea_viewport.setMinimumSize(
@@ -485,7 +783,7 @@ class MainWindow(QtWidgets.QMainWindow):
     # ================ Crop and text =================
 
     def mousePressEvent(self, event: QtGui.QMouseEvent):
-        pos_in_viewport = self.ui.imageLabel.mapFrom(self, event.pos())
+        pos_in_viewport = self.image_view.mapFrom(self, event.pos())
         if (
             self.working_pil_image
             and event.button() == QtCore.Qt.LeftButton
@@ -495,15 +793,14 @@ class MainWindow(QtWidgets.QMainWindow):
             self.rect_moved = False
         
             if (
-                self.ui.imageLabel.rect().contains(pos_in_viewport)
-                and self.ui.imageLabel.pixmap()
-                and not self.ui.imageLabel.pixmap().isNull()
+                self.image_view.image_rect().contains(pos_in_viewport)
+                and self.image_view.has_image()
             ):
 
                 self.crop_origin = pos_in_viewport
                 if not self.rubber_band:
                     self.rubber_band = QtWidgets.QRubberBand(
-                        QtWidgets.QRubberBand.Rectangle, self.ui.imageLabel
+                        QtWidgets.QRubberBand.Rectangle, self.image_view
                     )
                 self.rubber_band.setGeometry(
                     QtCore.QRect(self.crop_origin, QtCore.QSize())
@@ -521,7 +818,7 @@ class MainWindow(QtWidgets.QMainWindow):
     def mouseMoveEvent(self, event: QtGui.QMouseEvent):
         if self.crop_origin and self.rubber_band and self.current_tool == 'crop':
             self.rect_moved = True
-            current_pos_in_viewport = self.ui.imageLabel.mapFrom(self, event.pos())
+            current_pos_in_viewport = self.image_view.mapFrom(self, event.pos())
             self.rubber_band.setGeometry(
                 QtCore.QRect(self.crop_origin, current_pos_in_viewport).normalized()
             )
@@ -539,41 +836,30 @@ class MainWindow(QtWidgets.QMainWindow):
             and event.button() == QtCore.Qt.LeftButton
         ):
 
-            end_pos_in_viewport = self.ui.imageLabel.mapFrom(self, event.pos())
+            end_pos_in_viewport = self.image_view.mapFrom(self, event.pos())
             selection_rect_vp_coords = QtCore.QRect(
                 self.crop_origin, end_pos_in_viewport
             ).normalized()
             self.rect_moved = False
             selection_rect_vp_coords = selection_rect_vp_coords.intersected(
-                self.ui.imageLabel.rect()
+                self.image_view.image_rect()
             )
             self.rubber_band.hide()
 
-            current_display_pixmap = self.ui.imageLabel.pixmap()
             if (
                 self.working_pil_image
-                and current_display_pixmap
-                and not current_display_pixmap.isNull()
+                and self.image_view.has_image()
                 and selection_rect_vp_coords.isValid()
                 and selection_rect_vp_coords.width() > 0
                 and selection_rect_vp_coords.height() > 0
             ):
 
-                pixmap_size = current_display_pixmap.size()
-                image_size = self.working_pil_image.size
-                scale_x = image_size[0] / pixmap_size.width()
-                scale_y = image_size[1] / pixmap_size.height()
-
-
-                x = int(selection_rect_vp_coords.x() * scale_x)
-                y = int(selection_rect_vp_coords.y() * scale_y)
-                w = int(selection_rect_vp_coords.width() * scale_x)
-                h = int(selection_rect_vp_coords.height() * scale_y)
-                crop_box = (x, y, x + w, y + h)
-                self.push_undo_state()
-                self.base_image = self.base_image.crop(crop_box)
-
-                self.update_full_image()
+                x, y = self.image_view.to_image(selection_rect_vp_coords.topLeft())
+                right, bottom = self.image_view.to_image(
+                    selection_rect_vp_coords.bottomRight() + QtCore.QPoint(1, 1)
+                )
+                crop_box = (x, y, right, bottom)
+                self.apply_operation(Operation("crop", (crop_box,)))
 
                 self.ui.zoomSlider.setValue(100)
 
@@ -587,40 +873,6 @@ class MainWindow(QtWidgets.QMainWindow):
         super().mouseReleaseEvent(event)
 
 
-    def process_crop(self, selection_rect, displayed_pixmap):
-        if not self.working_pil_image or not displayed_pixmap:
-            return
-
-        pixmap_width = displayed_pixmap.width()
-        pixmap_height = displayed_pixmap.height()
-
-        image_width, image_height = self.working_pil_image.size
-
-        scale_x = image_width / pixmap_width
-        scale_y = image_height / pixmap_height
-
-        left = int(selection_rect.left() * scale_x)
-        upper = int(selection_rect.top() * scale_y)
-        right = int(selection_rect.right() * scale_x)
-        lower = int(selection_rect.bottom() * scale_y)
-
-        left = max(0, min(left, image_width))
-        right = max(0, min(right, image_width))
-        upper = max(0, min(upper, image_height))
-        lower = max(0, min(lower, image_height))
-
-        if right - left > 0 and lower - upper > 0:
-            self.push_undo_state()
-            cropped_image = self.working_pil_image.crop((left, upper, right, lower))
-            self.working_pil_image = cropped_image.copy()
-            self.original_pixmap = self.pil_image_to_pixmap(cropped_image)
-            self.zoom_factor = 1.0
-            self.update_display()
-            self.ui.statusbar.showMessage("Cropped image.")
-        else:
-            self.ui.statusbar.showMessage("Invalid crop area.")
-
-
     # ================ Event Handling =================
     def eventFilter(self, source, event):
         if source is self.ui.scrollArea_viewport.viewport():
@@ -648,6 +900,15 @@ class MainWindow(QtWidgets.QMainWindow):
 
         return super().eventFilter(source, event)
 
+    def closeEvent(self, event):
+        self.render_scheduler.stop()
+        self.image_loader.stop()
+        if self.image_saver.is_busy():
+            self.ui.statusbar.showMessage("Finishing save...")
+        self.image_saver.stop()
+        self.estimator.stop()
+        super().closeEvent(event)
+
     def show_about_dialog(self):
         dialog = AboutDialog(self)
         dialog.exec_()
@@ -748,6 +1009,12 @@ class CollapsiblePanel(QtWidgets.QWidget):
 
 
 if __name__ == "__main__":
+    # the export and batch process pools start from here in a frozen build
+    multiprocessing.freeze_support()
+    if sys.argv[1:2] == ["batch"]:
+        import batch
+        sys.exit(batch.main(sys.argv[2:]))
+
     app = QtWidgets.QApplication(sys.argv)
 
     splash_pix = QtGui.QPixmap(":/newPrefix/Ikony_inż/icon100.png")
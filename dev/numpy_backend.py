@@ -0,0 +1,96 @@
+import threading
+import numpy as np
+from PIL import Image
+
+import pipeline
+from pipeline import GRAY_WEIGHTS, to_rgb, update_filters
+
+
+# float32 working buffers, reused between renders of the same size. One set per
+# thread: the render worker and a synchronous save render may run at once.
+buffers = threading.local()
+weights = np.array(GRAY_WEIGHTS, np.float32)
+
+
+def work_buffers(shape):
+    if getattr(buffers, "shape", None) != shape:
+        buffers.shape = shape
+        buffers.work = np.empty(shape, np.float32)
+        buffers.smooth = np.empty(shape, np.float32)
+        buffers.gray = np.empty(shape[:2], np.float32)
+    return buffers.work, buffers.smooth, buffers.gray
+
+
+def settle(work):
+    # every step of the Pillow chain stores 8-bit values: clip and truncate
+    np.clip(work, 0, 255, out=work)
+    np.floor(work, out=work)
+
+
+def gray_of(work, gray):
+    # RGB -> L, rounded like Image.convert("L")
+    np.dot(work, weights, out=gray)
+    gray += 0.5
+    np.floor(gray, out=gray)
+    return gray
+
+
+def smooth_of(work, smooth):
+    # ImageFilter.SMOOTH: 3x3 kernel, 5 in the middle, 1 around, / 13.
+    # Pillow leaves the outermost pixels unfiltered, so do we.
+    height, width = work.shape[:2]
+    smooth[...] = work
+    inner = smooth[1:-1, 1:-1]
+    inner *= 5
+    for dy in range(3):
+        for dx in range(3):
+            if (dy, dx) != (1, 1):
+                inner += work[dy:dy + height - 2, dx:dx + width - 2]
+    inner /= 13
+    np.rint(inner, out=inner)
+    return smooth
+
+
+def update_adjustments(image, adjustments):
+    # gains, brightness and contrast are a table lookup on 8-bit values, which
+    # Image.point does faster than numpy fancy indexing
+    lut, _ = pipeline.tone_lut(
+        image, adjustments.gains, adjustments.brightness_factor, adjustments.contrast_factor
+    )
+    image = image.point(lut)
+    if adjustments.sharpness_factor == 1 and adjustments.saturation_factor == 1:
+        return image
+
+    pixels = np.asarray(image)
+    work, smooth, gray = work_buffers(pixels.shape)
+    np.copyto(work, pixels)
+
+    if adjustments.sharpness_factor != 1:
+        smooth_of(work, smooth)
+        work -= smooth
+        work *= adjustments.sharpness_factor
+        work += smooth
+        settle(work)
+
+    if adjustments.saturation_factor != 1:
+        gray = gray_of(work, gray)[..., None]
+        work -= gray
+        work *= adjustments.saturation_factor
+        work += gray
+        settle(work)
+
+    # fresh output array: Image.fromarray shares its memory, the buffers get reused
+    return Image.fromarray(work.astype(np.uint8))
+
+
+STAGES = (
+    ("rgb", to_rgb, lambda a: ()),
+    (
+        "numpy_adjustments",
+        update_adjustments,
+        lambda a: (a.red, a.green, a.blue, a.brightness, a.contrast, a.sharpness, a.saturation),
+    ),
+    ("filters", update_filters, lambda a: a.filters),
+)
+
+pipeline.BACKENDS["numpy"] = STAGES
@@ -0,0 +1,366 @@
+import threading, weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from PIL import Image, ImageFilter, ImageStat
+
+from filters import apply_filters, filters_radius
+from tiling import map_strips
+from timings import tracer
+
+
+@dataclass(frozen=True)
+class Adjustments:
+    # raw slider values, see MainWindow.current_adjustments
+    red: int = 100
+    green: int = 100
+    blue: int = 100
+    brightness: int = 0
+    contrast: int = 0
+    sharpness: int = 0
+    saturation: int = 0
+    filters: tuple = ()
+
+    @property
+    def gains(self):
+        return (self.red / 100, self.green / 100, self.blue / 100)
+
+    @property
+    def brightness_factor(self):
+        return 2 ** (self.brightness / 20)
+
+    @property
+    def contrast_factor(self):
+        return 3 ** (self.contrast / 20)
+
+    @property
+    def sharpness_factor(self):
+        return 3 ** (self.sharpness / 20)
+
+    @property
+    def saturation_factor(self):
+        return 3 ** (self.saturation / 20)
+
+
+# Per-image memo for values derived from an image that never changes (Pillow
+# images are unhashable, so entries are keyed by id and dropped with the image).
+class ImageMemo:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, image, compute):
+        key = id(image)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0]() is image:
+            return entry[1]
+        value = compute(image)
+        self.entries[key] = (weakref.ref(image, lambda ref: self.entries.pop(key, None)), value)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def nbytes(self):
+        # memory of the values that are images
+        values = [entry[1] for entry in list(self.entries.values())]
+        return sum(image_nbytes(value) for value in values if isinstance(value, Image.Image))
+
+
+histograms = ImageMemo()
+degenerates = ImageMemo()
+# per image: table before contrast -> gray mean. Moving only the contrast
+# slider keeps the table, so the gray pass runs once per gains/brightness.
+gray_means = ImageMemo()
+GRAY_MEANS_PER_IMAGE = 8
+
+# The tone table matches the ImageEnhance chain exactly. The single color matrix
+# does not: the chain truncates after every step, the matrix rounds once. It is
+# only used while matrix_error() allows at most this many levels; measured
+# differences stay within TONE_TOLERANCE (see test_pipeline.py). Saturation
+# done on its own is within 2 levels of ImageEnhance.Color.
+MAX_MATRIX_ERROR = 9
+TONE_TOLERANCE = 4
+
+
+def smooth_degenerate(image):
+    # the degenerate image of ImageEnhance.Sharpness
+    return map_strips(image, lambda strip: strip.filter(ImageFilter.SMOOTH), halo=1)
+
+# weights Pillow uses for RGB -> L
+GRAY_WEIGHTS = (19595 / 65536, 38470 / 65536, 7471 / 65536)
+
+
+def blend_value(degenerate, value, factor):
+    # same arithmetic as Image.blend(degenerate, image, factor) for a single value
+    out = degenerate + factor * (value - degenerate)
+    return 0 if out <= 0 else 255 if out >= 255 else int(out)
+
+
+def gain_lut(gains):
+    lut = []
+    for factor in gains:
+        lut += [max(0, min(255, int(i * factor))) for i in range(256)]
+    return lut
+
+
+def lut_gray_mean(image, lut):
+    # The mean ImageEnhance.Contrast takes of image.point(lut): the mean of the
+    # gray image, whose pixels are rounded one by one. The band histograms only
+    # give the mean of the unrounded values, which can be a level off.
+    means = gray_means.get(image, lambda image: OrderedDict())
+    key = tuple(lut)
+    if key in means:
+        means.move_to_end(key)
+    else:
+        gray = map_strips(image, lambda strip: strip.point(lut).convert("L"))
+        means[key] = int(ImageStat.Stat(gray).mean[0] + 0.5)
+        if len(means) > GRAY_MEANS_PER_IMAGE:
+            means.popitem(last=False)
+    return means[key]
+
+
+# Gains, brightness and contrast are all per channel point operations, so they
+# fold into one 3x256 table. Contrast blends towards the gray mean of its input,
+# which is taken from a gray pass over the table applied so far (memoized).
+def tone_lut(image, gains, brightness, contrast):
+    lut = gain_lut(gains)
+    if brightness != 1:
+        lut = [blend_value(0, v, brightness) for v in lut]
+    mean = 0
+    if contrast != 1:
+        mean = lut_gray_mean(image, lut)
+        lut = [blend_value(mean, v, contrast) for v in lut]
+    return lut, mean
+
+
+# Gains, brightness, contrast and ImageEnhance.Color are all linear color
+# transforms: x -> S (contrast * brightness * gains * x + (1 - contrast) * mean),
+# where S blends every channel with the gray value. Returns the 3x4 matrix for
+# Image.convert("RGB", matrix).
+def color_matrix(gains, brightness, contrast, mean, saturation):
+    matrix = []
+    for channel in range(3):
+        row = [(1 - saturation) * weight for weight in GRAY_WEIGHTS]
+        row[channel] += saturation
+        matrix += [row[i] * gains[i] * brightness * contrast for i in range(3)]
+        matrix.append(sum(row) * (1 - contrast) * mean)
+    return tuple(matrix)
+
+
+def clips_before_saturation(histogram, gains, brightness, contrast, mean):
+    # The matrix does not clip between steps, the step by step chain does. Every
+    # step is increasing, so only the darkest and brightest value of each band
+    # can clip first. Photos with 0 or 255 in them clip as soon as a gain or the
+    # brightness goes above 1, and take the two pass way.
+    for band, gain in enumerate(gains):
+        present = [i for i in range(256) if histogram[band * 256 + i]]
+        for value in present[:1] + present[-1:]:
+            value *= gain
+            steps = (value, value * brightness, contrast * (value * brightness - mean) + mean)
+            if not all(0 <= out <= 255 for out in steps):
+                return True
+    return False
+
+
+def matrix_error(gains, brightness, contrast, saturation):
+    # Worst case levels between the matrix, which rounds once, and the chain,
+    # which truncates after every step. Each truncation loses up to a level
+    # and the steps after it scale that loss.
+    loss = max(
+        contrast * brightness * (gain not in (0, 1)) + contrast * (brightness != 1) + (contrast != 1)
+        for gain in gains
+    )
+    return max(saturation, 1) * loss + abs(1 - saturation) / 2 + 1.5
+
+
+def single_matrix(image, gains, brightness, contrast, mean, saturation):
+    if matrix_error(gains, brightness, contrast, saturation) > MAX_MATRIX_ERROR:
+        return False
+    histogram = histograms.get(image, Image.Image.histogram)
+    return not clips_before_saturation(histogram, gains, brightness, contrast, mean)
+
+
+# The table and the matrix are worked out on the whole image (contrast needs its
+# mean), only applying them is split into strips.
+def adjust_tone(image, gains, brightness, contrast, saturation):
+    lut, mean = tone_lut(image, gains, brightness, contrast)
+    if saturation == 1:
+        return map_strips(image, lambda strip: strip.point(lut))
+
+    if single_matrix(image, gains, brightness, contrast, mean, saturation):
+        matrix = color_matrix(gains, brightness, contrast, mean, saturation)
+        return map_strips(image, lambda strip: strip.convert("RGB", matrix))
+    # something clips on the way or the matrix would drift too far, keep the
+    # exact table and only do saturation as a matrix
+    matrix = color_matrix((1, 1, 1), 1, 1, 0, saturation)
+    return map_strips(image, lambda strip: strip.point(lut).convert("RGB", matrix))
+
+
+def update_colors(image, adjustments):
+    lut = gain_lut(adjustments.gains)
+    return map_strips(image, lambda strip: strip.point(lut))
+
+
+# Saturation comes after sharpness in the chain. Only without sharpening, which
+# clips on its own, can it be folded into the tone matrix.
+def folded_saturation(adjustments):
+    return adjustments.saturation_factor if adjustments.sharpness_factor == 1 else 1
+
+
+def update_tone(image, adjustments):
+    return adjust_tone(
+        image,
+        adjustments.gains,
+        adjustments.brightness_factor,
+        adjustments.contrast_factor,
+        folded_saturation(adjustments),
+    )
+
+
+def update_sharpness(image, adjustments):
+    # factor 1 is an exact no-op for ImageEnhance, skip the degenerate image
+    factor = adjustments.sharpness_factor
+    if factor != 1:
+        # ImageEnhance.Sharpness, with the smoothed image kept per input: while
+        # only the sharpness slider moves, a render is just the blend
+        image = Image.blend(degenerates.get(image, smooth_degenerate), image, factor)
+    return image
+
+
+def update_saturation(image, adjustments):
+    if folded_saturation(adjustments) == adjustments.saturation_factor:
+        return image
+    matrix = color_matrix((1, 1, 1), 1, 1, 0, adjustments.saturation_factor)
+    return map_strips(image, lambda strip: strip.convert("RGB", matrix))
+
+
+def update_enhancements(image, adjustments):
+    image = adjust_tone(
+        image, (1, 1, 1), adjustments.brightness_factor, adjustments.contrast_factor, folded_saturation(adjustments)
+    )
+    image = update_sharpness(image, adjustments)
+    return update_saturation(image, adjustments)
+
+
+def update_filters(image, adjustments):
+    names = adjustments.filters
+    if not names:
+        return image
+    return map_strips(image, lambda strip: apply_filters(strip, names), halo=filters_radius(names))
+
+
+# same result as update_colors -> update_enhancements -> update_filters, with
+# the colors and the point-wise enhancements done in a single pass
+def apply_all_adjustments(image, adjustments, backend="pillow"):
+    for _, stage, _ in BACKENDS[backend]:
+        image = stage(image, adjustments)
+    return image
+
+
+def to_rgb(image, adjustments):
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+# (name, stage function, parameters the stage depends on)
+STAGES = (
+    ("rgb", to_rgb, lambda a: ()),
+    ("tone", update_tone, lambda a: (a.red, a.green, a.blue, a.brightness, a.contrast, folded_saturation(a))),
+    ("sharpness", update_sharpness, lambda a: (a.sharpness,)),
+    ("saturation", update_saturation, lambda a: (a.saturation if a.sharpness else 0,)),
+    ("filters", update_filters, lambda a: a.filters),
+)
+
+# name -> stages, other backends register themselves here (see numpy_backend.py)
+BACKENDS = {"pillow": STAGES}
+
+
+def image_nbytes(image):
+    # Pillow keeps multi-band 8-bit images at 4 bytes per pixel
+    return image.width * image.height * (1 if image.mode in ("1", "L", "P") else 4)
+
+
+# Stage outputs within a byte budget. Entries only hold their input weakly:
+# an entry dies with it, so the cache never keeps old base images or evicted
+# outputs alive behind the budget's back. reserved() is memory the cache's
+# entries keep alive elsewhere, such as the smoothed images in degenerates,
+# and counts against the budget too.
+class StageCache:
+    def __init__(self, budget, reserved=lambda: 0):
+        self.budget = budget  # bytes
+        self.reserved = reserved
+        self.entries = OrderedDict()  # key -> (weak reference to the upstream image, result)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # reentrant: dropping an evicted result can fire the callback of entries fed by it
+        self.lock = threading.RLock()
+
+    def get(self, key, upstream):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0]() is not upstream:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, upstream, result):
+        size = image_nbytes(result)
+        if size > self.budget:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            # the key holds id(upstream), which may be reused once upstream is gone
+            self.entries[key] = (weakref.ref(upstream, lambda ref: self.drop(key, ref)), result)
+            self.nbytes += size
+            while self.entries and self.nbytes + self.reserved() > self.budget:
+                _, entry = self.entries.popitem(last=False)
+                self.nbytes -= image_nbytes(entry[1])
+                del entry  # frees the result now, and whatever only it kept alive
+
+    def drop(self, key, ref):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is ref:
+                del self.entries[key]
+                self.nbytes -= image_nbytes(entry[1])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+def reduce_proxy(image, level):
+    # preview at 1 / 2**level of the size, averaging each block of pixels
+    return image.convert("RGB").reduce(2 ** level)
+
+
+# Runs the backend stages one after another and remembers every stage output,
+# keyed by the stage parameters and the identity of its input. A change only
+# recomputes the stages downstream of it. With a level the image is reduced
+# first, like any other stage, so a preview only pays for it once per image
+# and zoom level.
+class StagedPipeline:
+    def __init__(self, budget=512 * 1024 * 1024, backend="pillow"):
+        self.cache = StageCache(budget, degenerates.nbytes)
+        self.backend = backend
+
+    def set_backend(self, backend):
+        self.backend = backend
+
+    def render(self, image, adjustments, level=0):
+        stages = BACKENDS[self.backend]
+        if level:
+            stages = (("proxy", lambda image, adjustments: reduce_proxy(image, level), lambda a: level),) + stages
+        for name, stage, params in stages:
+            key = (name, id(image), params(adjustments))
+            with tracer.span(name):
+                result = self.cache.get(key, image)
+                if result is None:
+                    result = stage(image, adjustments)
+                    if result is not image:
+                        self.cache.put(key, image, result)
+            image = result
+        return image
@@ -0,0 +1,88 @@
+import multiprocessing, os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from PIL import Image
+
+from saving import SaveCancelled, encode
+
+
+# formats with a quality setting, and the highest value worth trying
+MAX_QUALITY = {"JPEG": 95, "WEBP": 100}
+
+WORKERS = os.cpu_count() or 1
+# workers start from a clean server process, forking the GUI with its Qt
+# threads running can leave a child stuck on a lock one of them held. Windows
+# has no forkserver, spawn is the only way there anyway.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# the image being searched, set once in each worker process
+search_image = None
+
+
+def init_worker(mode, size, pixels, palette):
+    global search_image
+    search_image = Image.frombytes(mode, size, pixels)
+    if palette:
+        search_image.putpalette(palette)
+
+
+def try_quality(image, image_type, params, target, quality):
+    # the encoding when it fits in target bytes, else None
+    data = encode(image, image_type, dict(params, quality=quality))
+    return data if len(data) <= target else None
+
+
+def try_search_image(image_type, params, target, quality):
+    # in a pool worker, the image came once with init_worker instead of with every call
+    return try_quality(search_image, image_type, params, target, quality)
+
+
+def candidates(low, high, count):
+    # count qualities splitting low..high into equal parts, or all of them if that many are left
+    if high - low + 1 <= count:
+        return list(range(low, high + 1))
+    return sorted({low + (high - low) * (index + 1) // (count + 1) for index in range(count)})
+
+
+# Finds the highest quality whose encoding is at most target bytes and returns
+# (quality, encoded bytes), or None if not even quality 1 fits. Encodes go to
+# memory, nothing is written. Each round tries `workers` qualities at once in a
+# process pool, which shrinks the range workers + 1 times instead of halving it.
+# workers=0 searches one quality at a time in this process, for small images
+# where starting processes would cost more than the encodes. Searches can run
+# on several threads at once, but not on the same image: Image.save keeps the
+# options of the save in progress on the image itself.
+def search_quality(image, image_type, target, params=None, workers=None, cancelled=None):
+    params = {key: value for key, value in (params or {}).items() if key not in ("quality", "target_size")}
+    if workers == 0:
+        try_qualities = partial(map, partial(try_quality, image, image_type, params, target))
+        return search(try_qualities, 1, image_type, cancelled)
+
+    workers = workers or WORKERS
+    palette = image.getpalette() if image.mode == "P" else None
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context(START_METHOD),
+        initializer=init_worker, initargs=(image.mode, image.size, image.tobytes(), palette)
+    ) as pool:
+        try_qualities = partial(pool.map, partial(try_search_image, image_type, params, target))
+        return search(try_qualities, workers, image_type, cancelled)
+
+
+def search(try_qualities, count, image_type, cancelled):
+    # the size grows with the quality, so whatever fits bounds the range from
+    # below and the lowest quality too big bounds it from above
+    best = None
+    low, high = 1, MAX_QUALITY[image_type]
+    while low <= high:
+        if cancelled and cancelled():
+            raise SaveCancelled()
+        qualities = candidates(low, high, count)
+        fitting, too_big = low - 1, high + 1
+        for quality, data in zip(qualities, try_qualities(qualities)):
+            if data is not None:
+                fitting, best = quality, (quality, data)
+            elif quality < too_big:
+                too_big = quality
+        low, high = fitting + 1, too_big - 1
+    return best
@@ -0,0 +1,81 @@
+import io, os, tempfile
+from PIL import Image
+
+
+# new files get the usual permissions, mkstemp would leave them at 0600
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+class SaveCancelled(Exception):
+    pass
+
+
+# File wrapper between the encoder and the temp file. Pillow writes encoded
+# data in blocks as it goes, which gives both progress and a place to stop.
+class WriteTracker:
+    def __init__(self, file, progress=None, cancelled=None):
+        self.file = file
+        self.written = 0
+        self.progress = progress
+        self.cancelled = cancelled
+
+    def write(self, data):
+        if self.cancelled and self.cancelled():
+            raise SaveCancelled()
+        self.file.write(data)
+        self.written += len(data)
+        if self.progress:
+            self.progress(self.written)
+        return len(data)
+
+    def fileno(self):
+        # with a file descriptor Pillow would encode straight into it, past write()
+        raise io.UnsupportedOperation("fileno")
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def image_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        return Image.registered_extensions()[extension]
+    except KeyError:
+        raise ValueError(f"unknown file extension: {extension}")
+
+
+def encode(image, image_type, params):
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_type, **params)
+    return buffer.getvalue()
+
+
+def save_atomic(image, path, progress=None, cancelled=None, **params):
+    image_type = image_format(path)
+    write_atomic(
+        path, lambda file: image.save(WriteTracker(file, progress, cancelled), format=image_type, **params)
+    )
+
+
+# Writes into a temp file next to path and renames it over path once complete,
+# so a failed or cancelled save never leaves a half written image behind
+def write_atomic(path, write):
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, temp_path = tempfile.mkstemp(prefix=".filtroo_", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        else:
+            os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
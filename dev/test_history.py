@@ -0,0 +1,137 @@
+import random, unittest
+from PIL import Image
+
+from history import History, Operation
+from pipeline import Adjustments
+
+
+MODES = ("RGB", "L", "RGBA", "P")
+
+# (checkpoint_interval, max_levels, memory_budget): replay between checkpoints,
+# trimming past max_levels, a limit below the interval so trim has to make its
+# own checkpoint, and a budget of one byte so every older checkpoint is spilled
+CONFIGS = (
+    (3, 500, 256 * 1024 * 1024),
+    (3, 7, 256 * 1024 * 1024),
+    (10, 4, 256 * 1024 * 1024),
+    (2, 500, 1),
+    (2, 6, 1),
+)
+
+
+def make_image(mode, seed):
+    noise = Image.effect_noise((64, 48), 40 + seed % 50)
+    image = Image.merge("RGB", [noise, noise.rotate(90 * seed), noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT)])
+    if mode == "P":
+        return image.quantize(64)
+    return image.convert(mode)
+
+
+def random_operation(rng, image):
+    width, height = image.size
+    kind = rng.choice(("rotate", "mirror", "crop", "resize", "text", "text", "adjust"))
+    if kind == "rotate":
+        return Operation("rotate", (rng.choice((90, 180, 270)),))
+    if kind == "mirror":
+        return Operation("mirror")
+    if kind == "crop" and width > 24 and height > 24:
+        return Operation("crop", ((rng.randrange(4), rng.randrange(4), width - rng.randrange(4), height - rng.randrange(4)),))
+    if kind in ("crop", "resize"):
+        return Operation("resize", ((rng.randrange(40, 80), rng.randrange(40, 80)),))
+    if kind == "text":
+        # partly off the image at times, the patch box is clipped
+        position = (rng.randrange(-10, width), rng.randrange(-10, height))
+        return Operation("text", (position, rng.choice(("a", "Hello", "XYZ 123")), rng.choice((10, 20)), "#ff0000"))
+    return Operation("adjust", (Adjustments(brightness=rng.randrange(-20, 21), filters=rng.choice(((), ("blur",)))),))
+
+
+class HistoryTest(unittest.TestCase):
+    def assert_same_image(self, image, expected, msg=None):
+        # palette images may gain colors from a text stamp, the visible pixels are what matters;
+        # compared in one go, a diff of the bytes would take ages to print
+        self.assertEqual(image.size, expected.size, msg)
+        self.assertTrue(image.convert("RGBA").tobytes() == expected.convert("RGBA").tobytes(), msg or "pixels differ")
+
+    def assert_state(self, history, states, index, msg=None):
+        image, adjustments = states[index]
+        self.assert_same_image(history.image, image, msg)
+        self.assertEqual(history.adjustments(), adjustments, msg)
+
+    def check_random_edits(self, mode, interval, max_levels, budget, seed):
+        rng = random.Random(seed)
+        image = make_image(mode, seed)
+        history = History(image, checkpoint_interval=interval, max_levels=max_levels, memory_budget=budget)
+        self.addCleanup(history.close)
+        # every state ever reached on the current branch; history.position is
+        # offset into it by however many states trim() has dropped
+        states, index = [(image, Adjustments())], 0
+
+        for step in range(250):
+            action = rng.choice(("push", "push", "push", "undo", "undo", "redo"))
+            if action == "push":
+                operation = random_operation(rng, states[index][0])
+                adjustments = operation.params[0] if operation.name == "adjust" else states[index][1]
+                history.push(operation)
+                states[index + 1:] = [(operation.apply(states[index][0]), adjustments)]
+                index += 1
+            elif action == "undo" and history.can_undo():
+                history.undo()
+                index -= 1
+            elif action == "redo" and history.can_redo():
+                history.redo()
+                index += 1
+
+            msg = f"step {step}: {action}"
+            self.assertLessEqual(len(history.operations), max_levels, msg)
+            self.assertEqual(len(states) - 1 - index, len(history.operations) - history.position, msg)
+            self.assert_state(history, states, index, msg)
+
+        # everything still in the history, oldest first, from checkpoints and replay alike
+        offset = index - history.position
+        while history.can_undo():
+            history.undo()
+            index -= 1
+        self.assertEqual(index, offset)
+        self.assert_state(history, states, index)
+        while history.can_redo():
+            history.redo()
+            index += 1
+            self.assert_state(history, states, index)
+
+    def test_random_edits(self):
+        for mode in MODES:
+            for interval, max_levels, budget in CONFIGS:
+                with self.subTest(mode=mode, interval=interval, max_levels=max_levels, budget=budget):
+                    self.check_random_edits(mode, interval, max_levels, budget, seed=len(mode) * 31 + interval * max_levels)
+
+    def test_spilled_checkpoints(self):
+        for mode in MODES:
+            with self.subTest(mode=mode):
+                image = make_image(mode, 1)
+                history = History(image, checkpoint_interval=1, memory_budget=1)
+                self.addCleanup(history.close)
+                states = [image]
+                for angle in (90, 180, 90, 270, 90, 90):
+                    states.append(history.push(Operation("rotate", (angle,))))
+                history.checkpoints.wait()
+                # all but the newest checkpoint had to leave RAM
+                self.assertEqual(history.usage()["disk"][0], len(states) - 1)
+                for index in reversed(range(len(states) - 1)):
+                    self.assert_same_image(history.undo(), states[index])
+
+    def test_text_undo_pastes_patch(self):
+        image = make_image("RGB", 2)
+        history = History(image)
+        self.addCleanup(history.close)
+        stamped = history.push(Operation("text", ((5, 5), "Hello", 20, "#ff0000")))
+        self.assertFalse(stamped.tobytes() == image.tobytes())
+        self.assertIsNotNone(history.patches[0])
+        undone = history.undo()
+        # a new image object, render caches key on identity
+        self.assertIsNot(undone, stamped)
+        self.assert_same_image(undone, image)
+        self.assert_same_image(history.redo(), stamped)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import os, unittest
+from PIL import Image
+
+import pipeline
+import tiling
+from filters import FILTERS, apply_filters
+from pipeline import Adjustments, BACKENDS, TONE_TOLERANCE, apply_all_adjustments
+from benchmark import SETTINGS, legacy_adjustments, make_image, max_difference
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# slider extremes where the matrix drifts furthest from the chain
+EXTREMES = (
+    Adjustments(red=172, green=65, blue=157, brightness=-8, contrast=20, saturation=16),
+    Adjustments(red=5, green=0, blue=0, brightness=-20, contrast=18, saturation=20),
+    Adjustments(red=122, green=0, blue=67, brightness=-17, contrast=-2, saturation=20),
+    Adjustments(red=0, green=40, blue=97, brightness=-20, contrast=-12, saturation=20),
+    Adjustments(red=0, green=28, blue=0, brightness=8, contrast=-4, saturation=20),
+    Adjustments(red=200, green=200, blue=200, brightness=20, contrast=20, saturation=-20),
+    Adjustments(red=60, green=140, blue=90, brightness=-3, contrast=7, saturation=-12),
+)
+
+# without saturation and sharpness everything is one table, exact
+TABLE_ONLY = (
+    Adjustments(red=133, green=177, blue=0, brightness=4, contrast=17),
+    Adjustments(red=80, green=100, blue=120, brightness=-15, contrast=-20),
+    Adjustments(red=200, green=0, blue=150, brightness=20, contrast=3),
+)
+
+
+def test_images():
+    return {
+        "splash": Image.open(os.path.join(HERE, "Ikony_inż", "splash.png")).convert("RGB"),
+        "icon": Image.open(os.path.join(HERE, "Ikony_inż", "4.png")).convert("RGB"),
+        "gradient": make_image(0.1, "RGB"),
+        "noise": Image.merge("RGB", [Image.effect_noise((256, 256), sigma).convert("L") for sigma in (10, 60, 120)]),
+    }
+
+
+class PipelineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.images = test_images()
+
+    def setUp(self):
+        pipeline.histograms.clear()
+        pipeline.gray_means.clear()
+        pipeline.degenerates.clear()
+
+    def assert_close(self, settings, tolerance):
+        for name, image in self.images.items():
+            expected = legacy_adjustments(image, settings)
+            for backend in BACKENDS:
+                with self.subTest(image=name, backend=backend, settings=settings):
+                    result = apply_all_adjustments(image, settings, backend)
+                    self.assertLessEqual(max_difference(result, expected), tolerance)
+
+    def test_table_is_exact(self):
+        for settings in TABLE_ONLY:
+            self.assert_close(settings, 0)
+
+    def test_presets(self):
+        for settings in SETTINGS.values():
+            self.assert_close(settings, TONE_TOLERANCE)
+
+    def test_extremes(self):
+        for settings in EXTREMES:
+            self.assert_close(settings, TONE_TOLERANCE)
+
+
+class FiltersTest(unittest.TestCase):
+    def test_strips_match_whole_image(self):
+        # strips split over threads see the rows around them they need
+        image = make_image(tiling.MIN_TILED_PIXELS / 1e6 + 0.1, "RGB")
+        workers, tiling.WORKERS = tiling.WORKERS, 4
+        try:
+            for names in (("blur",), ("detail", "edge_enhance"), ("contour", "sharpen", "smooth"), tuple(FILTERS)):
+                with self.subTest(filters=names):
+                    result = pipeline.update_filters(image, Adjustments(filters=names))
+                    self.assertEqual(max_difference(result, apply_filters(image, names)), 0)
+        finally:
+            tiling.WORKERS = workers
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+# Pillow releases the GIL inside filter, point, blend and convert, so plain
+# threads keep every core busy without pickling images to worker processes.
+WORKERS = os.cpu_count() or 1
+
+# below this many pixels splitting costs more than it saves
+MIN_TILED_PIXELS = 4_000_000
+
+executor = None
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="tile")
+    return executor
+
+
+def strips(height, count, halo):
+    # (top, bottom) of each output strip and (top, bottom) of the source rows it needs
+    for index in range(count):
+        top = height * index // count
+        bottom = height * (index + 1) // count
+        yield (top, bottom), (max(0, top - halo), min(height, bottom + halo))
+
+
+# Runs func on horizontal strips of image in parallel and stitches the results.
+# halo is how many rows above and below a strip func needs to get the strip
+# right: the sum of the kernel radii of every neighbourhood operation in func.
+# func must keep the image size and not depend on the image as a whole.
+def map_strips(image, func, halo=0, workers=None):
+    workers = workers or WORKERS
+    width, height = image.size
+    count = min(workers, height // max(1, 4 * halo))
+    if count < 2 or width * height < MIN_TILED_PIXELS:
+        return func(image)
+
+    def run(parts):
+        (top, bottom), (source_top, source_bottom) = parts
+        result = func(image.crop((0, source_top, width, source_bottom)))
+        return top, result.crop((0, top - source_top, width, bottom - source_top))
+
+    results = list(get_executor().map(run, strips(height, count, halo)))
+    stitched = Image.new(results[0][1].mode, image.size)
+    for top, strip in results:
+        stitched.paste(strip, (0, top))
+    return stitched
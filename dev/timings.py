@@ -0,0 +1,70 @@
+import os, json, time, threading, tempfile
+from contextlib import contextmanager
+
+
+# Opt-in per-stage timing. Spans are collected per render for the status bar
+# and appended to a Chrome trace file (chrome://tracing, ui.perfetto.dev).
+class Tracer:
+    def __init__(self, path=None):
+        self.enabled = False
+        self.path = path or os.environ.get(
+            "FILTROO_TRACE", os.path.join(tempfile.gettempdir(), "filtroo_trace.json")
+        )
+        self.frame = []  # (name, seconds) since the last take_frame
+        self.pending = []  # trace events not written yet
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), args)
+
+    def record(self, name, start, end, args=None):
+        event = {
+            "name": name,
+            "cat": "render",
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args or {},
+        }
+        with self.lock:
+            self.frame.append((name, end - start))
+            self.pending.append(event)
+
+    def take_frame(self):
+        with self.lock:
+            frame, self.frame = self.frame, []
+        return frame
+
+    def flush(self):
+        with self.lock:
+            events, self.pending = self.pending, []
+        if not events:
+            return
+        # JSON array format: the viewers accept a missing closing bracket, so the
+        # file can simply be appended to across sessions
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a") as file:
+            if new_file:
+                file.write("[\n")
+            for event in events:
+                file.write(json.dumps(event) + ",\n")
+
+
+def format_frame(frame):
+    total = sum(seconds for _, seconds in frame)
+    stages = " · ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in frame)
+    return f"Render {total * 1000:.0f} ms: {stages}"
+
+
+tracer = Tracer()
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from PyQt5 import QtCore, QtGui, QtWidgets
+from timings import tracer
+
+
+TILE_SIZE = 256
+TILE_CACHE_BUDGET = 64 * 1024 * 1024  # bytes of rendered tiles kept around
+
+
+# Mipmap pyramid of a rendered pixmap: level n is the source halved n times.
+# Levels are made on first use, each one from the level above it, so zooming
+# scales from the nearest level that is still at least the target size
+# instead of from full resolution.
+class PixmapPyramid:
+    def __init__(self, source):
+        self.source = source
+        self.levels = [source]
+
+    def level_for(self, size):
+        while True:
+            top = self.levels[-1]
+            half = top.size() / 2
+            if half.width() < max(size.width(), 1) or half.height() < max(size.height(), 1):
+                break
+            self.levels.append(
+                top.scaled(half, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+            )
+
+        for level in reversed(self.levels):
+            if level.width() >= size.width() and level.height() >= size.height():
+                return level
+        return self.levels[0]
+
+
+# Least recently used tiles, bounded by bytes rather than count
+class TileCache:
+    def __init__(self, budget=TILE_CACHE_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key, make):
+        tile = self.entries.get(key)
+        if tile is not None:
+            self.entries.move_to_end(key)
+            return tile
+
+        tile = make()
+        self.entries[key] = tile
+        self.size += tile_nbytes(tile)
+        while self.size > self.budget and len(self.entries) > 1:
+            _, old = self.entries.popitem(last=False)
+            self.size -= tile_nbytes(old)
+        return tile
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+def tile_nbytes(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+# Shows an image at any zoom without ever making the whole zoomed pixmap.
+# The widget is as big as the zoomed image, the scroll area only exposes
+# part of it, and paintEvent draws just the fixed-size tiles that part
+# touches. Scrolling blits what is already on screen, so panning only
+# renders the tiles that come into view.
+class TiledImageView(QtWidgets.QWidget):
+    def __init__(self, parent=None, tile_size=TILE_SIZE, cache_budget=TILE_CACHE_BUDGET):
+        super().__init__(parent)
+        self.tile_size = tile_size
+        self.tiles = TileCache(cache_budget)
+        self.pyramid = None
+        self.image_size = QtCore.QSize()  # full resolution size, the pixmap may be a preview
+        self.display_size = QtCore.QSize()  # zoomed size on screen
+        self.smooth = True  # False while zoom is being dragged: cheap unfiltered tiles
+        self.tiles_rendered = 0
+
+    def set_image(self, pixmap, image_size):
+        if self.pyramid is None or self.pyramid.source is not pixmap:
+            self.pyramid = PixmapPyramid(pixmap)
+            self.tiles.clear()
+        self.image_size = QtCore.QSize(image_size)
+        self.update()
+
+    def set_display_size(self, size):
+        size = size.expandedTo(QtCore.QSize(1, 1))
+        if size != self.display_size:
+            self.display_size = size
+            self.updateGeometry()
+            self.update()
+
+    def set_smooth(self, smooth):
+        if smooth != self.smooth:
+            self.smooth = smooth
+            self.update()
+
+    def has_image(self):
+        return self.pyramid is not None and not self.pyramid.source.isNull()
+
+    def sizeHint(self):
+        return self.display_size
+
+    def minimumSizeHint(self):
+        return self.display_size
+
+    def image_rect(self):
+        # the image is centered when the widget is larger than it
+        offset = QtCore.QPoint(
+            max(0, (self.width() - self.display_size.width()) // 2),
+            max(0, (self.height() - self.display_size.height()) // 2),
+        )
+        return QtCore.QRect(offset, self.display_size)
+
+    def to_image(self, pos):
+        # widget position -> pixel of the full resolution image
+        if not self.has_image() or self.display_size.isEmpty():
+            return None
+        point = pos - self.image_rect().topLeft()
+        x = int(point.x() * self.image_size.width() / self.display_size.width())
+        y = int(point.y() * self.image_size.height() / self.display_size.height())
+        return (x, y)
+
+    def paintEvent(self, event):
+        if not self.has_image() or self.display_size.isEmpty():
+            return
+        image_rect = self.image_rect()
+        exposed = event.rect().intersected(image_rect).translated(-image_rect.topLeft())
+        if exposed.isEmpty():
+            return
+
+        size = self.tile_size
+        painter = QtGui.QPainter(self)
+        with tracer.span("tiles"):
+            for row in range(exposed.top() // size, exposed.bottom() // size + 1):
+                for column in range(exposed.left() // size, exposed.right() // size + 1):
+                    painter.drawPixmap(
+                        image_rect.topLeft() + QtCore.QPoint(column * size, row * size),
+                        self.tile(column, row),
+                    )
+        painter.end()
+
+    def tile(self, column, row):
+        key = (self.display_size.width(), self.display_size.height(), self.smooth, column, row)
+        return self.tiles.get(key, lambda: self.render_tile(column, row))
+
+    def render_tile(self, column, row):
+        size = self.tile_size
+        rect = QtCore.QRect(column * size, row * size, size, size).intersected(
+            QtCore.QRect(QtCore.QPoint(), self.display_size)
+        )
+        level = self.pyramid.level_for(self.display_size)
+        scale_x = level.width() / self.display_size.width()
+        scale_y = level.height() / self.display_size.height()
+        source = QtCore.QRectF(
+            rect.x() * scale_x, rect.y() * scale_y, rect.width() * scale_x, rect.height() * scale_y
+        )
+
+        tile = QtGui.QPixmap(rect.size())
+        tile.fill(QtCore.Qt.transparent)
+        painter = QtGui.QPainter(tile)
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, self.smooth)
+        painter.drawPixmap(QtCore.QRectF(tile.rect()), level, source)
+        painter.end()
+        self.tiles_rendered += 1
+        return tile
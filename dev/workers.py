@@ -0,0 +1,303 @@
+import threading
+from PyQt5 import QtCore
+from PIL import Image
+
+from bridge import pil_to_qimage
+from loading import decode, open_preview
+from saving import SaveCancelled, image_format, save_atomic, write_atomic
+from export import estimate
+from quality_search import search_quality
+from timings import tracer
+
+
+class RenderWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal(object, object, object)  # PIL image, QImage, tag
+
+    def __init__(self, pipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    @QtCore.pyqtSlot(object, object, object, int)
+    def render(self, image, adjustments, tag, level):
+        image = self.pipeline.render(image, adjustments, level)
+        # QPixmap may only be created on the GUI thread, so hand back a QImage
+        with tracer.span("to QImage"):
+            qimage = pil_to_qimage(image)
+        self.finished.emit(image, qimage, tag)
+
+
+# Runs renders on a worker thread one at a time. While a render is running only
+# the newest request is kept, older pending ones are dropped and counted as skipped.
+class RenderScheduler(QtCore.QObject):
+    rendered = QtCore.pyqtSignal(object, object, object)  # PIL image, QImage, tag
+    idle = QtCore.pyqtSignal(int)  # renders skipped since the last idle
+    _dispatch = QtCore.pyqtSignal(object, object, object, int)
+
+    def __init__(self, pipeline, parent=None):
+        super().__init__(parent)
+        self.busy = False
+        self.pending = None
+        self.skipped = 0
+        self.total_skipped = 0
+
+        self.thread = QtCore.QThread()
+        self.worker = RenderWorker(pipeline)
+        self.worker.moveToThread(self.thread)
+        self._dispatch.connect(self.worker.render)
+        self.worker.finished.connect(self.on_finished)
+        self.thread.start()
+
+    # tag is passed through untouched and comes back with the result. level
+    # renders a preview at 1 / 2**level of the size, see StagedPipeline.render
+    def request(self, image, adjustments, tag=None, level=0):
+        if self.busy:
+            if self.pending is not None:
+                self.skipped += 1
+                self.total_skipped += 1
+            self.pending = (image, adjustments, tag, level)
+            return
+        self.start(image, adjustments, tag, level)
+
+    def start(self, image, adjustments, tag, level):
+        self.busy = True
+        self._dispatch.emit(image, adjustments, tag, level)
+
+    def is_idle(self):
+        return not self.busy and self.pending is None
+
+    def drop_pending(self):
+        # the running render still finishes, its tag tells whether it is wanted
+        self.pending = None
+
+    def on_finished(self, image, qimage, tag):
+        self.busy = False
+        if self.pending is not None:
+            self.start(*self.pending)
+            self.pending = None
+
+        self.rendered.emit(image, qimage, tag)
+        if self.is_idle():
+            self.idle.emit(self.skipped)
+            self.skipped = 0
+
+    def stop(self):
+        self.pending = None
+        self.thread.quit()
+        self.thread.wait()
+
+
+class LoadWorker(QtCore.QObject):
+    previewed = QtCore.pyqtSignal(object, object, object)  # PIL image, QImage, tag
+    progress = QtCore.pyqtSignal(int, object)  # percent decoded, tag
+    finished = QtCore.pyqtSignal(object, object, object)  # PIL image or None, error message, tag
+
+    @QtCore.pyqtSlot(object, object, object)
+    def load(self, path, tag, preview_size):
+        try:
+            if preview_size:
+                preview, _ = open_preview(path, preview_size)
+                if preview:
+                    self.previewed.emit(preview, pil_to_qimage(preview), tag)
+
+            percent = -1
+
+            def report(done):
+                nonlocal percent
+                if int(done * 100) != percent:
+                    percent = int(done * 100)
+                    self.progress.emit(percent, tag)
+
+            image = decode(path, report)
+        except (OSError, ValueError, Image.DecompressionBombError) as error:
+            self.finished.emit(None, str(error), tag)
+            return
+        self.finished.emit(image, None, tag)
+
+
+# Decodes images on a worker thread, one at a time in the order requested. With
+# a preview_size, large JPEGs first come back as a draft decoded preview.
+class ImageLoader(QtCore.QObject):
+    previewed = QtCore.pyqtSignal(object, object, object)  # PIL image, QImage, tag
+    progress = QtCore.pyqtSignal(int, object)  # percent decoded, tag
+    loaded = QtCore.pyqtSignal(object, object)  # PIL image, tag
+    failed = QtCore.pyqtSignal(str, object)  # error message, tag
+    _dispatch = QtCore.pyqtSignal(object, object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.thread = QtCore.QThread()
+        self.worker = LoadWorker()
+        self.worker.moveToThread(self.thread)
+        self._dispatch.connect(self.worker.load)
+        self.worker.previewed.connect(self.previewed)
+        self.worker.progress.connect(self.progress)
+        self.worker.finished.connect(self.on_finished)
+        self.thread.start()
+
+    def request(self, path, tag=None, preview_size=None):
+        self._dispatch.emit(path, tag, preview_size)
+
+    def on_finished(self, image, error, tag):
+        if image is None:
+            self.failed.emit(error, tag)
+        else:
+            self.loaded.emit(image, tag)
+
+    def stop(self):
+        self.thread.quit()
+        self.thread.wait()
+
+
+class SaveWorker(QtCore.QObject):
+    progress = QtCore.pyqtSignal(object, object)  # bytes written, tag
+    finished = QtCore.pyqtSignal(str, object, object)  # "saved", "cancelled" or "failed", error message, tag
+
+    # progress is reported every this many bytes
+    PROGRESS_STEP = 1024 * 1024
+
+    def __init__(self, pipeline):
+        super().__init__()
+        self.pipeline = pipeline
+
+    @QtCore.pyqtSlot(object, object, object, object, object, object)
+    def save(self, image, adjustments, path, params, cancelled, tag):
+        reported = 0
+
+        def report(written):
+            nonlocal reported
+            if written - reported >= self.PROGRESS_STEP:
+                reported = written
+                self.progress.emit(written, tag)
+
+        try:
+            if cancelled.is_set():
+                raise SaveCancelled()
+            if adjustments is not None:
+                image = self.pipeline.render(image, adjustments)
+            self.progress.emit(0, tag)
+            if "target_size" in params:
+                self.save_target(image, path, params, cancelled)
+            else:
+                save_atomic(image, path, report, cancelled.is_set, **params)
+        except SaveCancelled:
+            self.finished.emit("cancelled", None, tag)
+        except Exception as error:
+            # anything escaping a slot would abort the app, and the saver has
+            # to hear back about every save, e.g. BrokenProcessPool from a
+            # search worker that ran out of memory
+            self.finished.emit("failed", str(error) or type(error).__name__, tag)
+        else:
+            self.finished.emit("saved", None, tag)
+
+    def save_target(self, image, path, params, cancelled):
+        # the search encodes in memory, the winner is written as it is
+        found = search_quality(image, image_format(path), params["target_size"], params, cancelled=cancelled.is_set)
+        if found is None:
+            raise ValueError(f"the image does not fit in {params['target_size'] // 1024} KB at any quality")
+        write_atomic(path, lambda file: file.write(found[1]))
+
+    @QtCore.pyqtSlot()
+    def quit(self):
+        # queued like the saves, so it only runs once they are all written
+        QtCore.QThread.currentThread().quit()
+
+
+# Renders and encodes images for saving on a worker thread, in the order
+# requested. Saves can be cancelled until their last block is written.
+class ImageSaver(QtCore.QObject):
+    progress = QtCore.pyqtSignal(object, object)  # bytes written, tag
+    finished = QtCore.pyqtSignal(str, object, object)  # "saved", "cancelled" or "failed", error message, tag
+    _dispatch = QtCore.pyqtSignal(object, object, object, object, object, object)
+    _quit = QtCore.pyqtSignal()
+
+    def __init__(self, pipeline, parent=None):
+        super().__init__(parent)
+        self.active = {}  # id -> cancel event of saves not finished yet
+
+        self.thread = QtCore.QThread()
+        self.worker = SaveWorker(pipeline)
+        self.worker.moveToThread(self.thread)
+        self._dispatch.connect(self.worker.save)
+        self._quit.connect(self.worker.quit)
+        self.worker.progress.connect(self.on_progress)
+        self.worker.finished.connect(self.on_finished)
+        self.thread.start()
+
+    # image should not change afterwards; with adjustments it is rendered first
+    def request(self, image, adjustments, path, params=None, tag=None):
+        cancelled = threading.Event()
+        self.active[id(cancelled)] = cancelled
+        self._dispatch.emit(image, adjustments, path, params or {}, cancelled, (id(cancelled), tag))
+
+    def is_busy(self):
+        return bool(self.active)
+
+    def cancel(self):
+        for cancelled in self.active.values():
+            cancelled.set()
+
+    def on_progress(self, written, tag):
+        self.progress.emit(written, tag[1])
+
+    def on_finished(self, status, error, tag):
+        key, tag = tag
+        self.active.pop(key, None)
+        self.finished.emit(status, error, tag)
+
+    def stop(self):
+        # saves already requested are written out, not dropped: quitting the
+        # thread directly would leave the ones still queued behind
+        self._quit.emit()
+        self.thread.wait()
+
+
+class EstimateWorker(QtCore.QObject):
+    finished = QtCore.pyqtSignal(object, object, object)  # (bytes, seconds, quality) or None, error message, tag
+
+    @QtCore.pyqtSlot(object, object, object, object, object)
+    def estimate(self, sample, scale, image_format, params, tag):
+        try:
+            result = estimate(sample, scale, image_format, params)
+        except (OSError, ValueError, KeyError) as error:
+            self.finished.emit(None, str(error), tag)
+            return
+        self.finished.emit(result, None, tag)
+
+
+# Predicts export size and time on a worker thread. Like RenderScheduler only
+# the newest pending request is kept while one is running.
+class Estimator(QtCore.QObject):
+    estimated = QtCore.pyqtSignal(object, object, object)  # (bytes, seconds, quality) or None, error message, tag
+    _dispatch = QtCore.pyqtSignal(object, object, object, object, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.busy = False
+        self.pending = None
+
+        self.thread = QtCore.QThread()
+        self.worker = EstimateWorker()
+        self.worker.moveToThread(self.thread)
+        self._dispatch.connect(self.worker.estimate)
+        self.worker.finished.connect(self.on_finished)
+        self.thread.start()
+
+    def request(self, sample, scale, image_format, params, tag=None):
+        if self.busy:
+            self.pending = (sample, scale, image_format, params, tag)
+            return
+        self.busy = True
+        self._dispatch.emit(sample, scale, image_format, params, tag)
+
+    def on_finished(self, result, error, tag):
+        self.busy = False
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            self.request(*pending)
+            return  # the result is already out of date
+        self.estimated.emit(result, error, tag)
+
+    def stop(self):
+        self.pending = None
+        self.thread.quit()
+        self.thread.wait()